@@ -0,0 +1,365 @@
+"""
+Time-alignment of the EV transition trajectories of different entities (countries)
+
+Every entity's sales share series is shifted in time so that it correlates best with the average trajectory
+of all shifted entities. Calculating the average and the shifts is repeated until the shifts no longer change.
+The data is kept as dense entity x period matrices, so shifting is just index arithmetic.
+Periods can be years (consecutive integers) or dates on a regular grid (eg. monthly data),
+and the offsets can be refined to fractions of a period by interpolating the correlation peak.
+bootstrap_alignment() estimates how robust the offsets are by aligning resampled entities / periods many times.
+"""
+
+import os
+import statistics
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from typing import Dict, NamedTuple, Optional
+
+import numpy as np
+import pandas as pd
+from pandas.tseries.frequencies import to_offset
+
+from instrumentation import count, stage
+from utils import correlate_slice_normalized_batch
+from world_ev_data import SALES_SHARE_BEVS, SALES_SHARE_EVS, SALES_TOTAL
+
+
+class AlignmentResult(NamedTuple):
+    offsets: pd.Series
+    """ Time shift of every entity in periods of freq (positive: ahead of the average trajectory, negative: behind) """
+    mean: pd.DataFrame
+    """ The weighted average trajectory of all shifted entities, one column per share series """
+    shifted: pd.DataFrame
+    """ The shifted share series of all entities, columns are (share series, entity) """
+    iterations: int
+    """ Number of iterations used """
+    converged: bool
+    """ Whether the offsets stopped changing before max_iterations was reached """
+    freq: Optional[str]
+    """ Frequency of the periods (None for integer periods), eg. to report the offsets with delta_frequency_to_string """
+
+
+def _period_grid(data: pd.DataFrame, freq: Optional[str]) -> pd.Index:
+    """ All periods from the first to the last one in the data: consecutive integers or dates with the frequency freq """
+    periods = data.index.get_level_values(1)
+    if freq is None:
+        return pd.RangeIndex(int(periods.min()), int(periods.max()) + 1, name=data.index.names[1])
+    grid = pd.date_range(periods.min(), periods.max(), freq=freq, name=data.index.names[1])
+    assert grid.get_indexer(periods.unique()).min() >= 0, f"Periods are not aligned to the frequency {freq}"
+    return grid
+
+
+def _shifted_grid(grid: pd.Index, freq: Optional[str], shift: int, length: int) -> pd.Index:
+    """ A grid of length periods starting shift periods after the start of grid """
+    if freq is None:
+        return pd.RangeIndex(grid[0] + shift, grid[0] + shift + length, name=grid.name)
+    return pd.date_range(grid[0] + shift * to_offset(freq), periods=length, freq=freq, name=grid.name)
+
+
+def _dense(data: pd.DataFrame, share_columns: Dict[str, str], weight_column: str, grid: pd.Index):
+    """
+    Converts the (entity, period) indexed data into dense matrices on the period grid
+    :return: entities, shares (series x entity x period), weights (entity x period),
+             masks (entity x period, the extent of every entity's series)
+    """
+    entities = data.index.get_level_values(0).unique()
+    full_index = pd.MultiIndex.from_product([entities, grid], names=data.index.names)
+    dense = data.reindex(full_index)
+    shape = (len(entities), len(grid))
+
+    shares = np.stack([dense[c].to_numpy(dtype='float64', na_value=np.nan).reshape(shape) for c in share_columns.values()])
+    weights = dense[weight_column].to_numpy(dtype='float64', na_value=np.nan).reshape(shape)
+
+    # every entity's series extends from its first to its last row
+    present = pd.Series(True, index=data.index).reindex(full_index, fill_value=False).to_numpy().reshape(shape)
+    t = np.arange(shape[1])
+    starts = np.argmax(present, axis=1)
+    ends = shape[1] - np.argmax(present[:, ::-1], axis=1)
+    masks = (t >= starts[:, np.newaxis]) & (t < ends[:, np.newaxis])
+    return entities, shares, weights, masks
+
+
+def _shift(values: np.ndarray, offsets: np.ndarray, min_offset: int, length: int) -> np.ndarray:
+    """ Shifts every entity (second to last axis) of values by its offset onto a grid starting min_offset periods earlier """
+    shifted = np.full(values.shape[:-1] + (length,), np.nan)
+    rows = np.arange(values.shape[-2])[:, np.newaxis]
+    cols = np.arange(values.shape[-1])[np.newaxis, :] + (offsets - min_offset)[:, np.newaxis]
+    shifted[..., rows, cols] = values
+    return shifted
+
+
+def _shifted_mean(shares: np.ndarray, weights: np.ndarray, offsets: np.ndarray):
+    """
+    Weighted average trajectory of all shifted entities
+    :return: The offset of the start of the average trajectory to the data, the shifted shares and the average
+    """
+    min_offset, max_offset = min(int(offsets.min()), 0), max(int(offsets.max()), 0)
+    length = shares.shape[-1] + max_offset - min_offset
+    shifted_shares = _shift(shares, offsets, min_offset, length)
+    shifted_weights = _shift(weights, offsets, min_offset, length)
+
+    # like the groupby sums: missing products / weights are skipped, periods without any weight have no average
+    num = np.nansum(shifted_shares * shifted_weights, axis=1)
+    den = np.nansum(shifted_weights, axis=0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean = num / den
+    return min_offset, shifted_shares, mean
+
+
+def _peak_fraction(corrs: np.ndarray, peaks: np.ndarray) -> np.ndarray:
+    """ Sub-period position of the correlation peaks relative to the peak indices, from a parabola through their neighbours """
+    rows = np.arange(len(corrs))
+    left = corrs[rows, np.maximum(peaks - 1, 0)]
+    center = corrs[rows, peaks]
+    right = corrs[rows, np.minimum(peaks + 1, corrs.shape[1] - 1)]
+    curvature = left - 2 * center + right
+    with np.errstate(divide='ignore', invalid='ignore'):
+        fraction = np.where(curvature < 0, 0.5 * (left - right) / curvature, 0.)
+    return np.clip(fraction, -0.5, 0.5)
+
+
+def _align(shares: np.ndarray, weights: np.ndarray, masks: np.ndarray, offsets: np.ndarray, max_iterations: int):
+    """
+    Iterates the average trajectory and the offsets of the dense data until the offsets no longer change
+    (or alternate between two states, when an entity's own weight in the average moves its correlation peak)
+    :param offsets: The offsets to start with
+    :return: The offsets, the correlations of the last iteration (entity x grid offset) and their peaks,
+             the number of iterations and whether the offsets converged
+    """
+    converged = False
+    iterations = 0
+    previous = None
+    while iterations < max_iterations and not converged:
+        iterations += 1
+        min_offset, _, mean = _shifted_mean(shares, weights, offsets)
+
+        # consider the correlation of all share series
+        corrs = 0
+        for k in range(len(shares)):
+            grid_offsets, corrs_k, _ = correlate_slice_normalized_batch(mean[k], shares[k], masks)
+            corrs = corrs + corrs_k / len(shares)
+        peaks = np.argmax(corrs, axis=1)
+        new_offsets = grid_offsets[peaks] + min_offset - 1
+
+        converged = np.array_equal(new_offsets, offsets)
+        if not converged and previous is not None and np.array_equal(new_offsets, previous):
+            break
+        previous, offsets = offsets, new_offsets
+    return offsets, corrs, peaks, iterations, converged
+
+
+def align_trajectories(data: pd.DataFrame, share_columns: Optional[Dict[str, str]] = None,
+                       weight_column: str = SALES_TOTAL, freq: Optional[str] = None, fractional: bool = False,
+                       max_iterations: int = 100) -> AlignmentResult:
+    """
+    Aligns the share trajectories of all entities in time
+    :param data: Data indexed by (entity, period), periods are consecutive integers (eg. years) or dates (see freq)
+    :param share_columns: {name: column} of the share series to align, the correlations of all of them are averaged
+                          (default: EV and BEV sales shares)
+    :param weight_column: Column by which the average trajectory is weighted (default: total sales)
+    :param freq: Frequency of date periods, eg. 'MS' for monthly data dated to the start of the month
+    :param fractional: Refine the final offsets to fractions of a period by interpolating the correlation peaks
+    :param max_iterations: Stop after this many iterations even if the offsets still change
+    :return: The offsets, the average trajectory and the number of iterations used
+    """
+    if share_columns is None:
+        share_columns = {'EV': SALES_SHARE_EVS, 'BEV': SALES_SHARE_BEVS}
+
+    grid = _period_grid(data, freq)
+    entities, shares, weights, masks = _dense(data, share_columns, weight_column, grid)
+
+    offsets, corrs, peaks, iterations, converged = _align(shares, weights, masks, np.zeros(len(entities), dtype=int),
+                                                          max_iterations)
+    min_offset, shifted_shares, mean = _shifted_mean(shares, weights, offsets)
+    periods = _shifted_grid(grid, freq, min_offset, mean.shape[-1])
+    names = list(share_columns)
+    return AlignmentResult(
+        offsets=pd.Series(offsets + _peak_fraction(corrs, peaks) if fractional else offsets, index=entities, name='offset'),
+        mean=pd.DataFrame(mean.T, index=periods, columns=names),
+        shifted=pd.DataFrame(
+            shifted_shares.transpose(2, 0, 1).reshape(len(periods), -1), index=periods,
+            columns=pd.MultiIndex.from_product([names, entities])),
+        iterations=iterations,
+        converged=converged,
+        freq=freq,
+    )
+
+
+class BootstrapResult(NamedTuple):
+    offsets: pd.DataFrame
+    """ The offsets of every replicate, replicate x entity (NaN for entities without data in the replicate) """
+    converged: pd.Series
+    """ Whether the alignment of every replicate converged (else its offsets alternate between two states) """
+    intervals: pd.DataFrame
+    """ Per entity: the offset of all data, the mean and standard error of the replicates and the confidence interval """
+    mean: pd.DataFrame
+    """ The average trajectory of all data and its confidence band, columns are (share series, 'lower' / 'estimate' / 'upper') """
+    alignment: AlignmentResult
+    """ The alignment of all data """
+    resample: str
+    """ 'entities', 'periods' or 'both' """
+    jackknife: bool
+    """ Whether the replicates leave out one entity / period each instead of resampling randomly """
+    confidence: float
+    """ Confidence level of the intervals """
+
+
+def _replicate_weights(resample: str, jackknife: bool, replicates: int, entities: int, periods: int, seed: int):
+    """
+    :return: The weight of every entity in the average trajectory (replicate x entity, the number of times the entity
+             was drawn) and the periods used (replicate x period)
+    """
+    if jackknife:
+        assert resample in ('entities', 'periods'), "The jackknife leaves out either entities or periods"
+        n = entities if resample == 'entities' else periods
+        left_out = ~np.eye(n, dtype=bool)
+        if resample == 'entities':
+            return left_out.astype('float64'), np.ones((n, periods), dtype=bool)
+        return np.ones((n, entities)), left_out
+
+    rng = np.random.default_rng(np.random.SeedSequence(seed))
+    entity_weights = np.ones((replicates, entities))
+    used_periods = np.ones((replicates, periods), dtype=bool)
+    if resample in ('entities', 'both'):
+        entity_weights = rng.multinomial(entities, np.full(entities, 1 / entities), size=replicates).astype('float64')
+    if resample in ('periods', 'both'):
+        # the correlation has no notion of period weights, so periods drawn more than once are used once
+        used_periods = np.zeros((replicates, periods), dtype=bool)
+        used_periods[np.arange(replicates)[:, np.newaxis], rng.integers(0, periods, (replicates, periods))] = True
+    return entity_weights, used_periods
+
+
+def _align_replicates(shares: np.ndarray, weights: np.ndarray, masks: np.ndarray, start_offsets: np.ndarray,
+                      entity_weights: np.ndarray, used_periods: np.ndarray, max_iterations: int):
+    """
+    Aligns a chunk of replicates (run in the worker processes)
+    :return: The offsets (replicate x entity), whether the alignments converged and the start position
+             of the average trajectory on the period grid and the average trajectory (share series x period)
+             of every replicate
+    """
+    offsets = np.full(entity_weights.shape, np.nan)
+    converged = np.zeros(len(entity_weights), dtype=bool)
+    means = []
+    for r in range(len(entity_weights)):
+        replicate_shares = np.where(used_periods[r], shares, np.nan)
+        replicate_weights = weights * entity_weights[r][:, np.newaxis] * used_periods[r]
+        replicate_masks = masks & used_periods[r]
+        replicate_offsets, _, _, _, converged[r] = _align(replicate_shares, replicate_weights, replicate_masks,
+                                                          start_offsets, max_iterations)
+        min_offset, _, mean = _shifted_mean(replicate_shares, replicate_weights, replicate_offsets)
+        offsets[r] = np.where(replicate_masks.any(axis=1), replicate_offsets, np.nan)
+        means.append((min_offset, mean))
+    return offsets, converged, means
+
+
+def _intervals(values: np.ndarray, estimate: np.ndarray, jackknife: bool, confidence: float):
+    """
+    :param values: The replicate values (replicate x ...)
+    :param estimate: The value of all data
+    :return: The mean and standard error of the replicates and the lower and upper confidence bounds:
+             percentiles of the bootstrap replicates or the normal interval of the jackknife standard error
+             (NaN where less than half of the replicates have a value)
+    """
+    with warnings.catch_warnings():
+        # entities / periods without any replicate values
+        warnings.simplefilter('ignore', RuntimeWarning)
+        center = np.nanmean(values, axis=0)
+        n = np.isfinite(values).sum(axis=0)
+        if jackknife:
+            std = np.sqrt((n - 1) / n * np.nansum((values - center) ** 2, axis=0))
+            z = statistics.NormalDist().inv_cdf(0.5 + confidence / 2)
+            lower, upper = estimate - z * std, estimate + z * std
+        else:
+            std = np.nanstd(values, axis=0, ddof=1)
+            lower, upper = np.nanquantile(values, [(1 - confidence) / 2, (1 + confidence) / 2], axis=0)
+    enough = n >= len(values) / 2
+    return tuple(np.where(enough, x, np.nan) for x in (center, std, lower, upper))
+
+
+@stage('alignment.bootstrap')
+def bootstrap_alignment(data: pd.DataFrame, share_columns: Optional[Dict[str, str]] = None,
+                        weight_column: str = SALES_TOTAL, freq: Optional[str] = None, resample: str = 'entities',
+                        replicates: int = 1000, jackknife: bool = False, confidence: float = 0.9, seed: int = 0,
+                        workers: Optional[int] = None, max_iterations: int = 100) -> BootstrapResult:
+    """
+    Uncertainty of the alignment: aligns resampled data many times and reports the spread of the offsets
+    and of the average trajectory.
+    Resampling the entities changes their weight in the average trajectory (an entity drawn twice counts twice,
+    one not drawn is still aligned to the average of the others). Resampling the periods leaves out the periods
+    not drawn from all series. The offsets are only defined up to a common shift of all entities, so every replicate
+    starts at the offsets of all data and is shifted back by the median difference of its offsets to them.
+    The replicates are determined by the seed alone and run in chunks on a process pool.
+    :param data: Data indexed by (entity, period) like for align_trajectories()
+    :param share_columns: {name: column} of the share series to align (default: EV and BEV sales shares)
+    :param weight_column: Column by which the average trajectory is weighted (default: total sales)
+    :param freq: Frequency of date periods, eg. 'MS' for monthly data dated to the start of the month
+    :param resample: Resample 'entities', 'periods' or 'both'
+    :param replicates: Number of bootstrap replicates (the jackknife has one replicate per entity / period)
+    :param jackknife: Leave out one entity / period per replicate instead of resampling randomly
+    :param confidence: Confidence level of the intervals
+    :param seed: Seed of the random resampling
+    :param workers: Number of processes (default: all cores, 1 runs serially in this process)
+    :param max_iterations: Maximum number of iterations of every alignment
+    :return: The offsets of all replicates and the confidence intervals of the offsets and the average trajectory
+    """
+    if share_columns is None:
+        share_columns = {'EV': SALES_SHARE_EVS, 'BEV': SALES_SHARE_BEVS}
+    assert resample in ('entities', 'periods', 'both'), f"Unknown resampling '{resample}'"
+
+    alignment = align_trajectories(data, share_columns, weight_column, freq, max_iterations=max_iterations)
+    grid = _period_grid(data, freq)
+    entities, shares, weights, masks = _dense(data, share_columns, weight_column, grid)
+    start_offsets = alignment.offsets.to_numpy()
+
+    entity_weights, used_periods = _replicate_weights(resample, jackknife, replicates, len(entities), len(grid), seed)
+    count('replicates', len(entity_weights))
+    workers = max(1, min(workers or os.cpu_count() or 1, len(entity_weights)))
+    align_chunk = partial(_align_replicates, shares, weights, masks, start_offsets, max_iterations=max_iterations)
+    if workers > 1:
+        # a few chunks per process balance the load without sending every replicate separately
+        chunks = np.array_split(np.arange(len(entity_weights)), 4 * workers)
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(align_chunk, [entity_weights[c] for c in chunks],
+                                        [used_periods[c] for c in chunks]))
+    else:
+        results = [align_chunk(entity_weights, used_periods)]
+    offsets = np.concatenate([o for o, _, _ in results])
+    converged = np.concatenate([c for _, c, _ in results])
+    means = [m for _, _, chunk_means in results for m in chunk_means]
+
+    # remove the arbitrary common shift of every replicate
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        shifts = np.nan_to_num(np.round(np.nanmedian(offsets - start_offsets, axis=1)))
+    offsets -= shifts[:, np.newaxis]
+
+    # the average trajectories of all replicates on a common period grid
+    full_start = int(np.min([0, start_offsets.min()]))
+    starts = np.array([m for m, _ in means]) - shifts.astype(int)
+    first = min(starts.min(), full_start)
+    end = max(max(s + mean.shape[-1] for s, (_, mean) in zip(starts, means)), full_start + len(alignment.mean))
+    length = end - first
+    trajectories = np.full((len(means), len(share_columns), length), np.nan)
+    for r, (s, (_, mean)) in enumerate(zip(starts, means)):
+        trajectories[r, :, s - first:s - first + mean.shape[-1]] = mean
+    full_mean = np.full((len(share_columns), length), np.nan)
+    full_mean[:, full_start - first:full_start - first + len(alignment.mean)] = alignment.mean.to_numpy().T
+
+    center, std, lower, upper = _intervals(offsets, start_offsets, jackknife, confidence)
+    _, _, mean_lower, mean_upper = _intervals(trajectories, full_mean, jackknife, confidence)
+    periods = _shifted_grid(grid, freq, first, length)
+    names = list(share_columns)
+    return BootstrapResult(
+        offsets=pd.DataFrame(offsets, index=pd.RangeIndex(len(offsets), name='replicate'), columns=entities),
+        converged=pd.Series(converged, index=pd.RangeIndex(len(offsets), name='replicate'), name='converged'),
+        intervals=pd.DataFrame({'offset': start_offsets, 'mean': center, 'std': std, 'lower': lower, 'upper': upper},
+                               index=entities),
+        mean=pd.DataFrame(np.stack([mean_lower, full_mean, mean_upper], axis=-1).transpose(1, 0, 2).reshape(length, -1),
+                          index=periods, columns=pd.MultiIndex.from_product([names, ['lower', 'estimate', 'upper']])
+                          ).dropna(how='all'),
+        alignment=alignment,
+        resample=resample,
+        jackknife=jackknife,
+        confidence=confidence,
+    )
@@ -0,0 +1,337 @@
+"""
+Benchmarks of the data ingestion, alignment and figure rendering hot paths
+
+Every benchmark is timed over several repeats (the minimum wall time is reported) and its peak memory
+(Python and numpy allocations, measured with tracemalloc in a separate run) is recorded.
+The results are compared against a stored baseline, so regressions show up without any network access:
+
+    python benchmark.py                   # run all benchmarks and compare against the baseline
+    python benchmark.py -k align          # only run benchmarks whose name contains "align"
+    python benchmark.py --save-baseline   # store the results as the new baseline
+
+The KBA benchmarks use synthetic workbooks in the FZ 28.1 layout, generated from the committed aggregate.
+Timings depend on the machine, so the baseline should be re-recorded when the machine changes,
+and on noisy machines (shared or throttled CPUs) a larger --tolerance is needed.
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import tempfile
+import time
+import tracemalloc
+from typing import Any, Callable, Dict, List
+
+import babel.dates
+import numpy as np
+import pandas as pd
+from openpyxl import Workbook
+
+import de_kba_datagrabber as kba
+from utils import PowerType
+
+baseline_file = 'benchmark_baseline.json'
+
+default_tolerance = 0.5
+""" Relative slowdown / memory increase that is reported as regression """
+
+min_time_difference = 0.002
+""" Absolute slowdown in seconds below which differences are considered noise """
+
+min_duration = 1.0
+""" Benchmarks are repeated at least this many seconds (and at least their number of repeats) """
+
+benchmarks: Dict[str, Callable[[str], Callable[[], Any]]] = {}
+""" Benchmark name -> setup function, which gets a temporary folder and returns the function to benchmark """
+
+repeats: Dict[str, int] = {}
+
+
+def benchmark(name: str, repeat: int = 5):
+    """ Registers a setup function returning the function to benchmark """
+    def register(setup: Callable[[str], Callable[[], Any]]):
+        benchmarks[name] = setup
+        repeats[name] = repeat
+        return setup
+    return register
+
+
+def write_synthetic_fz28(folder: str, df: pd.DataFrame):
+    """
+    Writes a workbook in the layout of the KBA FZ 28 publication for every month of an FZ 28.1 aggregate
+    :param folder: Destination folder
+    :param df: The FZ 28.1 aggregate (fz28_1_aggregated())
+    """
+    os.makedirs(folder, exist_ok=True)
+    width = 14
+    dash = lambda x: "-" if x == 0 else x
+
+    def row(cells: Dict[int, Any]) -> List[Any]:
+        values = [None] * width
+        for column, value in cells.items():
+            values[column % width] = value
+        return values
+
+    for month in df.index:
+        wb = Workbook()
+        wb.active.title = "Impressum"
+        ws = wb.create_sheet("FZ 28.1")
+        ws.append(["Kraftfahrt-Bundesamt"])
+        ws.append([None, "FZ 28.1 Neuzulassungen von Kraftfahrzeugen nach Fahrzeugklassen"])
+        ws.append([])
+        for cells in [{1: "Fahrzeugklasse", 2: "Insgesamt", 3: "darunter alternative Antriebe insgesamt"},
+                      {4: "Benzin"},
+                      {10: "Hybrid", -2: "Gas", -1: "Wasserstoff"},
+                      {10: "insgesamt"},
+                      {7: "Elektro (BEV)", 8: "Brennstoffzelle", 9: "Plug-in-Hybrid"},
+                      {1: babel.dates.format_date(month, format='MMMM yyyy', locale='de_DE')}]:
+            ws.append(row(cells))
+        for kfztype in kba.kfztypes:
+            values = {p: int(df.loc[month, (kfztype, p)]) for p in list(kba.fz28_1_columns) + [PowerType.ICE]}
+            alternative = sum(values[p] for p in kba.fz28_1_columns)
+            ws.append(row({1: kfztype, 2: alternative + values[PowerType.ICE], 3: dash(alternative),
+                           **{c: dash(values[p]) for p, c in kba.fz28_1_columns.items()}}))
+        ws.append([None, "1) Fußnote"])
+        wb.save(os.path.join(folder, f"fz28_{month.year}_{month.month:02d}.xlsx"))
+
+
+@contextlib.contextmanager
+def kba_datafolder(folder: str):
+    """ Temporarily uses another KBA data folder """
+    original = kba.datafolder
+    kba.datafolder = folder
+    try:
+        yield
+    finally:
+        kba.datafolder = original
+
+
+def committed_fz28_1() -> pd.DataFrame:
+    """ The committed CSV export of the FZ 28.1 aggregate, like fz28_1_aggregated() """
+    df = pd.read_csv(f"{kba.datafolder}/fz28_1_aggregated.csv", header=[0, 1], index_col=0)
+    df.columns = kba.fz28_1_all_columns()
+    df.index = pd.Index(pd.to_datetime(df.index).date, name=df.index.name)
+    return df
+
+
+def synthetic_fz28_folder(tmp: str) -> str:
+    folder = os.path.join(tmp, "de-kba")
+    write_synthetic_fz28(folder, committed_fz28_1())
+    return folder
+
+
+@benchmark('kba_do_aggregate', repeat=3)
+def bench_kba_do_aggregate(tmp: str):
+    folder = synthetic_fz28_folder(tmp)
+
+    def run():
+        with kba_datafolder(folder), contextlib.redirect_stdout(io.StringIO()):
+            return kba.fz28_1_do_aggregate(workers=1)
+    return run
+
+
+@benchmark('kba_aggregated_cold', repeat=3)
+def bench_kba_aggregated_cold(tmp: str):
+    folder = synthetic_fz28_folder(tmp)
+
+    def run():
+        with kba_datafolder(folder), contextlib.redirect_stdout(io.StringIO()):
+            if os.path.exists(f"{folder}/fz28_1_aggregated.parquet"):
+                os.remove(f"{folder}/fz28_1_aggregated.parquet")
+            return kba.fz28_1_aggregated(workers=1)
+    return run
+
+
+@benchmark('kba_aggregated_warm', repeat=20)
+def bench_kba_aggregated_warm(tmp: str):
+    folder = synthetic_fz28_folder(tmp)
+    with kba_datafolder(folder), contextlib.redirect_stdout(io.StringIO()):
+        kba.fz28_1_aggregated(workers=1)
+
+    def run():
+        with kba_datafolder(folder):
+            return kba.fz28_1_aggregated()
+    return run
+
+
+@benchmark('kba_metrics', repeat=20)
+def bench_kba_metrics(tmp: str):
+    df = committed_fz28_1()
+    return lambda: kba.fz28_1_compute_metrics(df)
+
+
+@benchmark('owid_electric_car_sales', repeat=20)
+def bench_owid_electric_car_sales(tmp: str):
+    from owid_datagrabber import owid_electric_car_sales
+    return owid_electric_car_sales
+
+
+@benchmark('owid_data', repeat=20)
+def bench_owid_data(tmp: str):
+    from world_ev_data import owid_data
+    return owid_data
+
+
+def correlation_benchmark(n: int):
+    def setup(tmp: str):
+        from utils import correlate_slice_normalized
+        rng = np.random.default_rng(n)
+        a, v = rng.random(n), rng.random(n // 2)
+        return lambda: correlate_slice_normalized(a, v)
+    return setup
+
+
+for _n in [32, 256, 2048]:
+    benchmark(f'correlate_slice_normalized_{_n}', repeat=50)(correlation_benchmark(_n))
+
+
+@benchmark('align_countries', repeat=10)
+def bench_align_countries(tmp: str):
+    from owid_datagrabber import owid_electric_car_sales
+    from world_ev_figures import align_countries, country_sales
+    relevant_sales = country_sales(owid_electric_car_sales())
+    return lambda: align_countries(relevant_sales)
+
+
+@benchmark('bootstrap_alignment_100', repeat=3)
+def bench_bootstrap_alignment(tmp: str):
+    from alignment import bootstrap_alignment
+    from owid_datagrabber import owid_electric_car_sales
+    from world_ev_figures import country_sales
+    relevant_sales = country_sales(owid_electric_car_sales())
+    return lambda: bootstrap_alignment(relevant_sales, {'EV': 'ev_sales_share', 'BEV': 'bev_share_car_sales'},
+                                       'total_cars_sold', replicates=100, workers=1)
+
+
+@benchmark('fit_s_curves', repeat=10)
+def bench_fit_s_curves(tmp: str):
+    from s_curves import fit_s_curves
+    from world_ev_data import owid_data
+    from world_ev_figures import country_sales
+    relevant_sales = country_sales(owid_data())
+    return lambda: fit_s_curves(relevant_sales)
+
+
+@benchmark('simulate_fleet_scenarios', repeat=5)
+def bench_simulate_fleet_scenarios(tmp: str):
+    from fleet_simulation import kba_fleet_data, s_curve_scenarios, simulate_fleet, world_fleet_data
+    from s_curves import fit_s_curves
+    from world_ev_data import SALES_SHARE_EVS
+    data = pd.concat([world_fleet_data('owid'), kba_fleet_data(committed_fz28_1())])
+    fit = fit_s_curves(data, {'EV': SALES_SHARE_EVS}, horizon=26)
+    # 220 scenarios
+    scenarios = s_curve_scenarios(fit, saturation=[None, .6, .8, 1.], midpoint_shift=range(-5, 6),
+                                  steepness_factor=[.6, .8, 1., 1.25, 1.5])
+    return lambda: simulate_fleet(data, scenarios)
+
+
+def render_benchmark(module_name: str, index: int):
+    def setup(tmp: str):
+        import matplotlib
+        matplotlib.use('Agg')
+        import figure_pipeline
+        if module_name == 'de_kba_figures':
+            import de_kba_figures
+            figures = de_kba_figures.figures(kba.fz28_1_compute_metrics(committed_fz28_1(),
+                                                                        de_kba_figures.monthy_average_window))
+        else:
+            import world_ev_figures
+            from owid_datagrabber import owid_electric_car_sales
+            figures = world_ev_figures.figures(owid_electric_car_sales())
+        figure = figures[index]
+        figure = figure._replace(path=os.path.join(tmp, os.path.basename(figure.path)))
+        return lambda: figure_pipeline.render(figure)
+    return setup
+
+
+for _name, _module, _index in [('render_bev_share', 'de_kba_figures', 0),
+                               ('render_by_power_type', 'de_kba_figures', 2),
+                               ('render_fuel_share_pies', 'de_kba_figures', 5),
+                               ('render_all_trajectories', 'world_ev_figures', 0),
+                               ('render_country_trajectory', 'world_ev_figures', 1)]:
+    benchmark(_name, repeat=3)(render_benchmark(_module, _index))
+
+
+def run_benchmark(name: str) -> Dict[str, float]:
+    """
+    :return: Minimum wall time in seconds and peak traced memory in bytes of a benchmark
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        func = benchmarks[name](tmp)
+        # the first call warms up imports and caches
+        func()
+        times = []
+        while len(times) < repeats[name] or sum(times) < min_duration:
+            start = time.perf_counter()
+            func()
+            times.append(time.perf_counter() - start)
+
+        tracemalloc.start()
+        try:
+            func()
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+    return {'time': min(times), 'peak_memory': peak}
+
+
+def compare(results: Dict[str, Dict[str, float]], baseline: Dict[str, Dict[str, float]], tolerance: float) -> List[str]:
+    """
+    Prints the results next to the baseline
+    :return: The names of the benchmarks that regressed
+    """
+    regressions = []
+    print(f'{"benchmark":<36} {"time":>10} {"baseline":>10} {"ratio":>6}  {"peak MB":>8} {"baseline":>8}')
+    for name, result in results.items():
+        base = baseline.get(name)
+        line = f'{name:<36} {result["time"] * 1000:>8.2f}ms'
+        if base:
+            ratio = result['time'] / base['time']
+            slower = ratio > 1 + tolerance and result['time'] - base['time'] > min_time_difference
+            more_memory = result['peak_memory'] > base['peak_memory'] * (1 + tolerance)
+            line += f' {base["time"] * 1000:>8.2f}ms {ratio:>6.2f}'
+            line += f'  {result["peak_memory"] / 1e6:>8.2f} {base["peak_memory"] / 1e6:>8.2f}'
+            if slower or more_memory:
+                regressions.append(name)
+                line += '  REGRESSION' + (' (time)' if slower else '') + (' (memory)' if more_memory else '')
+        else:
+            line += f' {"-":>10} {"-":>6}  {result["peak_memory"] / 1e6:>8.2f} {"-":>8}'
+        print(line)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks the ingestion, alignment and rendering hot paths')
+    parser.add_argument('-k', dest='filter', default='', help='Only run benchmarks whose name contains this string')
+    parser.add_argument('--save-baseline', action='store_true', help=f'Store the results in {baseline_file}')
+    parser.add_argument('--tolerance', type=float, default=default_tolerance,
+                        help='Relative slowdown / memory increase reported as regression')
+    args = parser.parse_args()
+
+    results = {}
+    for name in benchmarks:
+        if args.filter in name:
+            results[name] = run_benchmark(name)
+
+    baseline = {}
+    if os.path.exists(baseline_file):
+        with open(baseline_file, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)['results']
+
+    regressions = compare(results, baseline, args.tolerance)
+
+    if args.save_baseline:
+        with open(baseline_file, 'w', encoding='utf-8') as f:
+            json.dump({'machine': f'{platform.platform()}, {platform.processor() or platform.machine()}, '
+                                  f'{os.cpu_count()} cores, Python {platform.python_version()}',
+                       'results': {**baseline, **results}}, f, indent=1, sort_keys=True)
+    elif regressions:
+        print(f'{len(regressions)} regression(s): {", ".join(regressions)}')
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,14 +1,26 @@
+from __future__ import annotations
+
+import hashlib
 import html
+import json
 import os
 
-import requests
 import re
 import datetime
-import babel.dates
-import pandas as pd
-from typing import List
+import queue
+import threading
+import zipfile
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from functools import partial
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple
+
+from download_utils import download_all, session
+from instrumentation import count, stage
+from utils import PowerType, file_hash, intor_array, lazy_import, newest_file_in_dir
 
-from utils import PowerType, intor, newest_file_in_dir
+# only loaded when the data is processed, so checking for updates starts quickly
+np = lazy_import('numpy')
+pd = lazy_import('pandas')
 
 datafolder = "data/de-kba"
 
@@ -16,6 +28,7 @@ kfztypes = ["Krafträder", "Personenkraftwagen", "Kraftomnibusse", "Lastkraftwag
             "Sattelzugmaschinen", "Sonstige Kfz"]
 
 
+@stage('kba.list')
 def fz28_get_list() -> List[str]:
     """
     Get the Neuzulassungen Alternative Antriebe statistics
@@ -27,12 +40,15 @@ def fz28_get_list() -> List[str]:
     # https://www.kba.de/SharedDocs/Downloads/DE/Statistik/Fahrzeuge/FZ28/fz28_2025_07.xlsx?__blob=publicationFile&v=2
     # Fetch webpage and regex search for links
 
+    import requests
+
     base_url = "https://www.kba.de"
     search_url = f"{base_url}/DE/Statistik/Produktkatalog/produkte/Fahrzeuge/fz28/fz28_gentab.html"
 
     try:
-        response = requests.get(search_url)
+        response = session().get(search_url, timeout=60)
         response.raise_for_status()
+        count('bytes_downloaded', len(response.content))
 
         # Find all Excel file links using regex
         excel_pattern = r'href="(/SharedDocs/Downloads/DE/Statistik/Fahrzeuge/FZ28/fz28_[^"]+\.xlsx[^"]+)'
@@ -48,125 +64,842 @@ def fz28_get_list() -> List[str]:
         return []
 
 
-def fz28_1_do_aggregate() -> pd.DataFrame:
+parallel_min_files = 8
+""" Minimum number of files to parse before the aggregation switches to parallel parsing by default """
+
+download_queue_size = 8
+""" Maximum number of downloaded files waiting to be parsed in fz28_fetch_and_aggregate() """
+
+failed_subfolder = "failed"
+""" Subfolder of the datafolder that monthly files failing to parse are moved to (see fz28_quarantine()) """
+
+fz28_1_columns = {
+    PowerType.BEV: 7,
+    PowerType.FCEV: 8,
+    PowerType.PHEV: 9,
+    PowerType.HEV: 10,
+    PowerType.Gas: -2,
+    PowerType.HY: -1,
+}
+""" Column positions of the power types in table FZ 28.1 (ICE is derived from the totals) """
+
+cache_schema_version = 1
+""" Version of the layout of the aggregate caches, caches of other versions are ignored and rebuilt """
+
+
+def fz28_1_all_columns() -> pd.MultiIndex:
+    """
+    :return: The columns of the FZ 28.1 aggregate, all vehicle types by all power types
+    """
+    return pd.MultiIndex.from_product([kfztypes, list(PowerType)], names=['Vehicle Type', 'Power Type'])
+
+
+def fz28_files() -> List[str]:
+    """
+    :return: The names of all downloaded monthly FZ 28 files, sorted by date
+    """
+    return [f for f in sorted(os.listdir(datafolder)) if re.match(r"fz28_([0-9]+)_([0-9]+).xlsx", f)]
+
+
+def fz28_file_month(file: str) -> datetime.date:
+    """ The month of a monthly FZ 28 file name, eg. fz28_2025_07.xlsx """
+    year, month = re.match(r"fz28_([0-9]+)_([0-9]+).xlsx", file).groups()
+    return datetime.date(int(year), int(month), 1)
+
+
+def _read_table(workbook, file: str, sheet_name: str, anchor: str, anchor_column: int, nrows: int,
+                max_search_rows: int) -> pd.DataFrame:
+    """ Reads a table from an open workbook, see fz28_read_table() """
+    sheet = workbook[sheet_name]
+    # the dimensions stored in the file are not always correct
+    sheet.reset_dimensions()
+    rows = []
+    for i, row in enumerate(sheet.iter_rows(values_only=True)):
+        if rows or (len(row) > anchor_column and row[anchor_column] == anchor):
+            rows.append(row)
+            if len(rows) >= nrows:
+                break
+        elif i >= max_search_rows:
+            break
+
+    assert rows, f"'{anchor}' not found in sheet '{sheet_name}' of {file}"
+
+    # Trim trailing empty cells like pd.read_excel, so negative column positions refer to the last table column
+    width = max((max((j + 1 for j, v in enumerate(row) if v is not None), default=0) for row in rows))
+    return pd.DataFrame([list(row[:width]) + [None] * (width - len(row)) for row in rows])
+
+
+def fz28_read_table(file: str, sheet_name: str, anchor: str = "Fahrzeugklasse", anchor_column: int = 1,
+                    nrows: int = 20, max_search_rows: int = 50) -> pd.DataFrame:
+    """
+    Reads a table from a FZ 28 workbook without loading the whole sheet:
+    The sheet is streamed in read-only mode until the anchor cell is found, then only the following rows are read.
+    :param file: Path to the workbook
+    :param sheet_name: Sheet containing the table, eg. "FZ 28.1"
+    :param anchor: Cell value marking the first row of the table
+    :param anchor_column: Column in which to look for the anchor
+    :param nrows: Number of rows to read, starting with the anchor row
+    :param max_search_rows: Number of rows to search for the anchor before giving up
+    :return: The table with positional index and columns (the anchor row is row 0), like pd.read_excel would read it
+    """
+    import openpyxl
+
+    workbook = openpyxl.load_workbook(file, read_only=True, data_only=True, keep_links=False)
+    try:
+        return _read_table(workbook, file, sheet_name, anchor, anchor_column, nrows, max_search_rows)
+    finally:
+        workbook.close()
+
+
+def fz28_1_extract(data: pd.DataFrame, month: datetime.date) -> pd.DataFrame:
+    """
+    Extracts the registrations of all vehicle types by power type from table FZ 28.1
+    :param data: The table as read by fz28_read_table()
+    :param month: The month of the workbook
+    :return: A dataframe with a single row for the month, columns fz28_1_all_columns()
+    """
+    import babel.dates
+
+    month_year = babel.dates.format_date(month, format='MMMM yyyy', locale='de_DE')
+    print(month_year)
+    assert data.iat[5, 1] == month_year
+
+    # Slice the whole block of vehicle classes at once: total, alternative total and the power type columns
+    block = data.iloc[6:6 + len(kfztypes)]
+    assert all(kfztype in name for kfztype, name in zip(kfztypes, block.iloc[:, 1]))
+    positions = [2, 3] + [c % data.shape[1] for c in fz28_1_columns.values()]
+    values = intor_array(block.iloc[:, positions].to_numpy())
+    total, alternative, by_power_type = values[:, 0], values[:, 1], values[:, 2:]
+    assert (by_power_type.sum(axis=1) == alternative).all()
+
+    row = np.column_stack([by_power_type, total - alternative])
+    columns = pd.MultiIndex.from_product([kfztypes, list(fz28_1_columns) + [PowerType.ICE]],
+                                         names=['Vehicle Type', 'Power Type'])
+    df = pd.DataFrame(row.reshape(1, -1), index=[month], columns=columns)
+    return df.reindex(columns=fz28_1_all_columns())
+
+
+class FZ28Table(NamedTuple):
+    key: str
+    """ Name of the cached aggregate of the table: {datafolder}/{key}_aggregated.parquet (and .csv) """
+    sheet: str
+    """ Sheet containing the table """
+    nrows: int
+    """ Number of rows to read, starting with the anchor row """
+    checks: List[Tuple[int, int, str]]
+    """ Sanity checks of the layout: (row, column, text contained in the cell), positions like in fz28_read_table() """
+    columns: Callable[[], pd.MultiIndex]
+    """ All columns of the aggregate (two levels, the cache stores them as "level 0|level 1") """
+    extract: Callable[[pd.DataFrame, datetime.date], pd.DataFrame]
+    """ Extracts the row of the month from the table (after the checks passed), with the columns of columns() """
+    anchor: str = "Fahrzeugklasse"
+    """ Cell value marking the first row of the table """
+    anchor_column: int = 1
+    """ Column in which to look for the anchor """
+    max_search_rows: int = 50
+    """ Give up if the anchor is not found within this many rows """
+
+
+fz28_tables = {
+    # Some individual months apparently accidentally have a line missing, so the table is located by its anchor
+    "FZ 28.1": FZ28Table(
+        key="fz28_1", sheet="FZ 28.1", nrows=6 + len(kfztypes),
+        checks=[(0, 1, "Fahrzeugklasse"), (4, 7, "Elektro"), (4, 8, "Brennstoffzelle"), (4, 9, "Plug-in-Hybrid"),
+                (2, 10, "Hybrid"), (3, 10, "insgesamt"), (2, -2, "Gas"), (2, -1, "Wasserstoff")],
+        columns=fz28_1_all_columns, extract=fz28_1_extract),
+}
+"""
+The tables extracted from the monthly FZ 28 workbooks, by name. Every workbook is opened once for all tables,
+and every table is aggregated into its own cache (see fz28_aggregated()), so adding a table here costs little extra.
+"""
+
+
+def fz28_parse_file(file: str, folder: Optional[str] = None,
+                    tables: Optional[List[str]] = None) -> Dict[str, pd.DataFrame]:
+    """
+    Parses the tables of a single downloaded monthly file, opening the workbook only once
+    :param file: File name of the monthly file
+    :param folder: Folder containing the file (default: datafolder)
+    :param tables: Names of the tables to parse (default: all fz28_tables)
+    :return: {table name: a dataframe with a single row for the month of the file}
+    """
+    import openpyxl
+
+    path = f"{folder or datafolder}/{file}"
+    month = fz28_file_month(file)
+    result = {}
+    workbook = openpyxl.load_workbook(path, read_only=True, data_only=True, keep_links=False)
+    try:
+        for name in tables or list(fz28_tables):
+            table = fz28_tables[name]
+            data = _read_table(workbook, path, table.sheet, table.anchor, table.anchor_column, table.nrows,
+                               table.max_search_rows)
+            for row, column, text in table.checks:
+                inside = row < data.shape[0] and -data.shape[1] <= column < data.shape[1]
+                cell = data.iat[row, column] if inside else None
+                assert isinstance(cell, str) and text in cell, \
+                    f"{name} of {file}: '{text}' expected in cell ({row}, {column}), found {cell!r}"
+            result[name] = table.extract(data, month)
+    finally:
+        workbook.close()
+    return result
+
+
+def fz28_1_parse_file(file: str, folder: Optional[str] = None) -> pd.DataFrame:
+    """
+    Parses table FZ 28.1 of a single downloaded monthly file
+    :param file: File name of the monthly file
+    :param folder: Folder containing the file (default: datafolder)
+    :return: A dataframe with a single row for the month of the file, columns like fz28_1_do_aggregate()
+    """
+    return fz28_parse_file(file, folder, ["FZ 28.1"])["FZ 28.1"]
+
+
+def _parse_tables(job: Tuple[str, List[str]], folder: str) -> Dict[str, pd.DataFrame]:
+    file, tables = job
+    return fz28_parse_file(file, folder, tables)
+
+
+def fz28_file_errors() -> Tuple[type, ...]:
+    """
+    :return: The exceptions raised by a monthly file that cannot be parsed (a broken workbook or a changed layout),
+             as opposed to errors of the environment (eg. a missing package, a broken process pool)
+    """
+    from openpyxl.utils.exceptions import InvalidFileException
+
+    return AssertionError, zipfile.BadZipFile, InvalidFileException, KeyError, ValueError
+
+
+def fz28_quarantine(file: str, error: Exception):
+    """
+    Moves a monthly file that failed to parse (eg. a truncated download) out of the datafolder,
+    so it is left out of the aggregates and downloaded again by the next update
+    """
+    folder = f"{datafolder}/{failed_subfolder}"
+    print(f"File {file} .. Error parsing file data: {error!r}, moved to {folder}")
+    count('parse_errors')
+    if os.path.exists(f"{datafolder}/{file}"):
+        os.makedirs(folder, exist_ok=True)
+        os.replace(f"{datafolder}/{file}", f"{folder}/{file}")
+
+
+@stage('kba.parse')
+def fz28_do_aggregate(files: Dict[str, List[str]], workers: int = 1) -> Dict[str, pd.DataFrame]:
+    """
+    Aggregates tables of the downloaded monthly files in one pass, every file is opened once
+    :param files: {file name: names of the tables to parse from it}
+    :param workers: Number of processes parsing the files in parallel (1 parses serially in this process)
+    :return: {table name: a dataframe of the monthly rows of the table}, for every table parsed from any file
+    """
+    count('files_parsed', len(files))
+    jobs = list(files.items())
+
+    if workers > 1 and len(jobs) > 1:
+        # Parsing is CPU-bound in openpyxl, so use processes; map keeps the order of the files
+        with ProcessPoolExecutor(max_workers=min(workers, len(jobs))) as executor:
+            parsed = list(executor.map(partial(_parse_tables, folder=datafolder), jobs))
+    else:
+        parsed = [_parse_tables(job, datafolder) for job in jobs]
+
+    result = {}
+    for name in {name for tables in files.values() for name in tables}:
+        rows = [p[name] for p in parsed if name in p]
+        result[name] = pd.concat(rows).sort_index()
+    return result
+
+
+def fz28_1_do_aggregate(files: Optional[List[str]] = None, workers: int = 1) -> pd.DataFrame:
     """
     Aggregates the downloaded monthly file data from table FZ 28.1:
     FZ 28.1 Neuzulassungen von Kraftfahrzeugen im September 2021 nach Fahrzeugklassen sowie nach ausgewählten Kraftstoffarten bzw. Energiequellen
+    :param files: Only aggregate these file names (default: all downloaded monthly files)
+    :param workers: Number of processes parsing the files in parallel (1 parses serially in this process)
     :return: A dataframe of monthly data aggregated by vehicle type (kfztypes) and power type
     """
+    if files is None:
+        files = fz28_files()
+    if not files:
+        return pd.DataFrame(columns=fz28_1_all_columns(), index=pd.DatetimeIndex([]))
+    return fz28_do_aggregate({file: ["FZ 28.1"] for file in files}, workers)["FZ 28.1"]
 
-    # Dataframe that will contain car type by fuel type by time
-    columns = pd.MultiIndex.from_product([kfztypes, list(PowerType)], names=['Vehicle Type', 'Power Type'])
-
-    # Create an empty DataFrame with datetime index and specified columns
-    df = pd.DataFrame(columns=columns, index=pd.DatetimeIndex([]))
-
-    all_files = sorted(os.listdir(datafolder))
-    for i, file in enumerate(all_files):
-        if m := re.match(r"fz28_([0-9]+)_([0-9]+).xlsx", file):
-            year, month = m.groups()
-            ymonth = datetime.date(int(year), int(month), 1)
-            data = pd.read_excel(f"{datafolder}/{file}", sheet_name="FZ 28.1")
-
-            # Some individual months apparently accidentally have a line missing, so we need to adjust
-            ystart = 6 if data.iat[6, 1] == "Fahrzeugklasse" else 5
-
-            # sanity checks
-            assert "Fahrzeugklasse" == data.iat[ystart, 1]
-            assert "Elektro" in data.iat[ystart + 4, 7]
-            assert "Brennstoffzelle" in data.iat[ystart + 4, 8]
-            assert "Plug-in-Hybrid" in data.iat[ystart + 4, 9]
-            assert "Hybrid" in data.iat[ystart + 2, 10]
-            assert "insgesamt" in data.iat[ystart + 3, 10]
-            assert "Gas" in data.iat[ystart + 2, -2]
-            assert "Wasserstoff" in data.iat[ystart + 2, -1]
-
-            month_year = babel.dates.format_date(ymonth, format='MMMM yyyy', locale='de_DE')
-            print(month_year)
-            assert data.iat[ystart + 5, 1] == month_year
-
-            for j, kfztype in enumerate(kfztypes):
-                l = ystart + 6 + j
-                assert kfztype in data.iat[l, 1]
-                total = intor(data.iat[l, 2])
-                df.loc[ymonth, (kfztype, PowerType.BEV)] = intor(data.iat[l, 7])
-                df.loc[ymonth, (kfztype, PowerType.FCEV)] = intor(data.iat[l, 8])
-                df.loc[ymonth, (kfztype, PowerType.PHEV)] = intor(data.iat[l, 9])
-                df.loc[ymonth, (kfztype, PowerType.HEV)] = intor(data.iat[l, 10])
-                df.loc[ymonth, (kfztype, PowerType.Gas)] = intor(data.iat[l, -2])
-                df.loc[ymonth, (kfztype, PowerType.HY)] = intor(data.iat[l, -1])
-                assert df.loc[ymonth, kfztype].sum() == intor(data.iat[l, 3])
-                df.loc[ymonth, (kfztype, PowerType.ICE)] = total - intor(data.iat[l, 3])
-    
-    df.sort_index(inplace=True)
-    return df
 
+def fz28_cache_file(name: str) -> str:
+    """ The Parquet cache of the aggregate of a table """
+    return f"{datafolder}/{fz28_tables[name].key}_aggregated.parquet"
 
-def fz28_1_aggregated() -> pd.DataFrame:
+
+def fz28_read_cache(file: str, all_columns: pd.MultiIndex) -> Tuple[Optional[pd.DataFrame], Dict[str, str]]:
     """
-    Gets the aggregated table FZ 28.1 (from file cache if available):
-    FZ 28.1 Neuzulassungen von Kraftfahrzeugen im September 2021 nach Fahrzeugklassen sowie nach ausgewählten Kraftstoffarten bzw. Energiequellen
-    :return: A dataframe of monthly data aggregated by vehicle type (kfztypes) and power type
+    Reads a cached aggregate (memory-mapped, only the requested columns)
+    :param file: The Parquet cache file
+    :param all_columns: The columns to read
+    :return: The aggregate with all requested columns (None if there is no cache of the current schema version)
+             and the content hashes of the monthly files it contains
     """
+    import pyarrow.parquet as pq
+
+    if not os.path.exists(file):
+        return None, {}
+    parquet_file = pq.ParquetFile(file, memory_map=True)
+    schema = parquet_file.schema_arrow
+    metadata = schema.metadata or {}
+    if metadata.get(b"schema_version") != str(cache_schema_version).encode():
+        print(f"Ignoring cache {file} of another schema version")
+        return None, {}
+
+    flat_names = [f"{level_0}|{level_1}" for level_0, level_1 in all_columns]
+    columns = ["date"] + [c for c in flat_names if c in schema.names]
+    df = parquet_file.read(columns=columns).to_pandas().set_index("date")
+    df.index.name = None
+    # the unpopulated columns are not stored
+    df = df.reindex(columns=flat_names)
+    df.columns = all_columns
+    return df, json.loads(metadata[b"files"])
+
+
+def fz28_1_read_cache(file: str, vehicle_types: Optional[List[str]] = None) -> Tuple[Optional[pd.DataFrame], Dict[str, str]]:
+    """
+    Reads the cached FZ 28.1 aggregate (memory-mapped, only the columns of the requested vehicle types)
+    :param file: The Parquet cache file
+    :param vehicle_types: Only read these vehicle types (default: all kfztypes)
+    :return: The aggregate with all vehicle type x power type columns (None if there is no cache of the current
+             schema version) and the content hashes of the monthly files it contains
+    """
+    all_columns = fz28_1_all_columns()
+    if vehicle_types is not None:
+        all_columns = all_columns[all_columns.get_level_values(0).isin(vehicle_types)]
+    return fz28_read_cache(file, all_columns)
 
-    # Check if there is a data file newer than the cached pickle
-    _, latest_mtime = newest_file_in_dir(datafolder, "fz28_*.xlsx")
 
-    file = f"{datafolder}/fz28_1_aggregated.pkl"
-    if os.path.exists(file) and os.path.getmtime(file) > latest_mtime:
-        # if pickle exists and is newer than the latest file, load it
-        return pd.read_pickle(file)
+def fz28_cached_files(file: str) -> Optional[Dict[str, str]]:
+    """
+    :return: The content hashes of the monthly files contained in an aggregate cache, only read from its metadata
+             (None if there is no cache of the current schema version)
+    """
+    import pyarrow.parquet as pq
+
+    if not os.path.exists(file):
+        return None
+    metadata = pq.read_schema(file, memory_map=True).metadata or {}
+    if metadata.get(b"schema_version") != str(cache_schema_version).encode():
+        return None
+    return json.loads(metadata[b"files"])
+
+
+def fz28_write_cache(file: str, df: pd.DataFrame, file_hashes: Dict[str, str]):
+    """
+    Writes an aggregate to a Parquet cache: only the populated columns are stored, named "level 0|level 1"
+    (eg. "vehicle type|power type"),
+    the schema metadata holds the schema version and the content hashes of the monthly files
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    flat = df.dropna(axis=1, how="all")
+    flat.columns = [f"{level_0}|{level_1}" for level_0, level_1 in flat.columns]
+    table = pa.Table.from_pandas(flat.rename_axis("date").reset_index(), preserve_index=False)
+    # the pandas metadata is not needed to restore the frame, and leaving it out keeps the cache independent of pandas versions
+    table = table.replace_schema_metadata({
+        b"schema_version": str(cache_schema_version).encode(),
+        b"files": json.dumps(file_hashes, sort_keys=True).encode(),
+    })
+    # write to a temporary file first, so an interrupted write never leaves a broken cache behind
+    # (the table is small, so statistics and dictionary pages would only add overhead)
+    pq.write_table(table, f"{file}.tmp", compression="zstd", use_dictionary=False, write_statistics=False)
+    os.replace(f"{file}.tmp", file)
+
+
+def fz28_stale_files(file_hashes: Optional[Dict[str, str]] = None) -> Dict[str, List[str]]:
+    """
+    :param file_hashes: Content hashes of the monthly files (default: of all downloaded files)
+    :return: {file name: the tables whose cached aggregate does not (or no longer) contain the file}
+    """
+    if file_hashes is None:
+        file_hashes = {fname: file_hash(f"{datafolder}/{fname}") for fname in fz28_files()}
+    cached = {name: fz28_cached_files(fz28_cache_file(name)) or {} for name in fz28_tables}
+    stale = {fname: [name for name in fz28_tables if cached[name].get(fname) != digest]
+             for fname, digest in file_hashes.items()}
+    return {fname: tables for fname, tables in stale.items() if tables}
 
-    # otherwise regenerate the pickle (and also CSV)
-    df = fz28_1_do_aggregate()
-    df.to_pickle(file)
-    df.to_csv(f"{datafolder}/fz28_1_aggregated.csv")
+
+def fz28_merge_into_cache(name: str, rows: Optional[pd.DataFrame], file_hashes: Dict[str, str]) -> pd.DataFrame:
+    """
+    Merges new rows into the cached aggregate of a table and rewrites the cache (and its CSV copy)
+    :param name: Name of the table in fz28_tables
+    :param rows: The newly parsed rows (None: no new rows, eg. to create an empty aggregate)
+    :param file_hashes: Content hashes of the monthly files the aggregate now contains
+    :return: The complete aggregate
+    """
+    table = fz28_tables[name]
+    file = fz28_cache_file(name)
+    df, cached_hashes = fz28_read_cache(file, table.columns())
+    if rows is not None:
+        df = rows if df is None else pd.concat([df.drop(index=rows.index, errors="ignore"), rows])
+        df.sort_index(inplace=True)
+    elif df is None:
+        df = pd.DataFrame(columns=table.columns(), index=pd.DatetimeIndex([]))
+    # months whose files are no longer downloaded stay in the aggregate
+    fz28_write_cache(file, df, {**cached_hashes, **file_hashes})
+    df.to_csv(f"{datafolder}/{table.key}_aggregated.csv")
     return df
 
 
-def fetch_all(files: List[str], only_new: bool = True) -> int:
+def fz28_update_aggregates(workers: Optional[int] = None, file_hashes: Optional[Dict[str, str]] = None,
+                           files: Optional[Dict[str, List[str]]] = None) -> Dict[str, pd.DataFrame]:
+    """
+    Brings the cached aggregates of all fz28_tables up to date in one pass over the new or changed monthly files:
+    every file is opened once and all tables whose cache does not contain it yet are extracted from it.
+    :param workers: Number of parsing processes (default: all cores if at least parallel_min_files need parsing)
+    :param file_hashes: Content hashes of the monthly files (default: of all downloaded files)
+    :param files: {file name: tables} to parse, fz28_stale_files(file_hashes) if the caller already has it
+                  (default: computed from file_hashes)
+    :return: {table name: the complete aggregate}
+    """
+    if file_hashes is None:
+        file_hashes = {fname: file_hash(f"{datafolder}/{fname}") for fname in fz28_files()}
+    stale = fz28_stale_files(file_hashes) if files is None else files
+    if stale:
+        print(f"Aggregating {len(stale)} new or changed file(s)")
+        if workers is None:
+            workers = (os.cpu_count() or 1) if len(stale) >= parallel_min_files else 1
+    new_rows = fz28_do_aggregate(stale, workers or 1) if stale else {}
+
+    result = {}
+    for name, table in fz28_tables.items():
+        if name not in new_rows:
+            df, _ = fz28_read_cache(fz28_cache_file(name), table.columns())
+            if df is not None:
+                result[name] = df
+                continue
+        result[name] = fz28_merge_into_cache(name, new_rows.get(name), file_hashes)
+    return result
+
+
+@stage('kba.aggregate')
+def fz28_aggregated(name: str, workers: Optional[int] = None, columns: Optional[pd.MultiIndex] = None) -> pd.DataFrame:
+    """
+    Gets the aggregate of a table (from file cache if available).
+    The cache records the content hash of every monthly file it contains,
+    if there are new or changed files the aggregates of all tables are updated in one pass (fz28_update_aggregates()).
+    :param name: Name of the table in fz28_tables
+    :param workers: Number of parsing processes (default: all cores if at least parallel_min_files need parsing)
+    :param columns: Only return these columns (default: all columns of the table)
+    :return: A dataframe of monthly data
+    """
+    table = fz28_tables[name]
+    # Find the files that are not (or no longer) represented in the cache
+    df, cached_hashes = fz28_read_cache(fz28_cache_file(name), table.columns() if columns is None else columns)
+    file_hashes = {fname: file_hash(f"{datafolder}/{fname}") for fname in fz28_files()}
+    changed = [fname for fname, digest in file_hashes.items() if cached_hashes.get(fname) != digest]
+    count('cache_hits', len(file_hashes) - len(changed))
+    count('cache_misses', len(changed))
+
+    if df is not None and not changed:
+        return df
+
+    df = fz28_update_aggregates(workers, file_hashes)[name]
+    return df if columns is None else df.reindex(columns=columns)
+
+
+def fz28_1_aggregated(workers: Optional[int] = None, vehicle_types: Optional[List[str]] = None) -> pd.DataFrame:
+    """
+    Gets the aggregated table FZ 28.1 (from file cache if available):
+    FZ 28.1 Neuzulassungen von Kraftfahrzeugen im September 2021 nach Fahrzeugklassen sowie nach ausgewählten Kraftstoffarten bzw. Energiequellen
+    Only new or changed files are parsed and merged into the cached aggregate, see fz28_aggregated().
+    :param workers: Number of parsing processes (default: all cores if at least parallel_min_files need parsing)
+    :param vehicle_types: Only return these vehicle types (default: all kfztypes)
+    :return: A dataframe of monthly data aggregated by vehicle type (kfztypes) and power type
+    """
+    columns = None
+    if vehicle_types is not None:
+        columns = fz28_1_all_columns()
+        columns = columns[columns.get_level_values(0).isin(vehicle_types)]
+    return fz28_aggregated("FZ 28.1", workers, columns)
+
+rolling_window = 6
+""" Default number of months of the rolling shares """
+
+power_type_groups = {
+    "BEV": [PowerType.BEV],
+    "PHEV": [PowerType.PHEV],
+    "Gas": [PowerType.CNG],
+    "Other": [p for p in PowerType if p not in {PowerType.BEV, PowerType.PHEV, PowerType.CNG, PowerType.ICE}],
+    "ICE": [PowerType.ICE],
+}
+""" Groups of power types for summarized plots, "Other" holds all power types not in another group """
+
+
+class FZ28Metrics(NamedTuple):
+    totals: pd.DataFrame
+    """ Registrations of all power types, month x vehicle type """
+    shares: pd.DataFrame
+    """ Share of every power type, month x (vehicle type, power type), NaN for months without registrations or data """
+    rolling_shares: pd.DataFrame
+    """ Centered rolling mean over window months of the shares, where missing shares count as 0 """
+    groups: pd.DataFrame
+    """ Registrations of the power_type_groups, month x (vehicle type, group) """
+    group_shares: pd.DataFrame
+    """ Share of the power_type_groups, month x (vehicle type, group) """
+    window: int
+    """ Number of months of the rolling shares """
+
+
+def fz28_1_group_columns() -> pd.MultiIndex:
+    return pd.MultiIndex.from_product([kfztypes, list(power_type_groups)], names=['Vehicle Type', 'Group'])
+
+
+def fz28_1_rolling_shares(shares: pd.DataFrame, window: int) -> pd.DataFrame:
+    """
+    Centered rolling mean like shares.fillna(0).rolling(window, min_periods=1, center=True).mean(),
+    but every window is summed on its own, so a partial recomputation gives exactly the same values
+    """
+    values = shares.fillna(0.0).to_numpy()
+    padded = np.pad(values, ((window // 2, window - window // 2 - 1), (0, 0)), constant_values=np.nan)
+    windows = np.lib.stride_tricks.sliding_window_view(padded, window, axis=0)
+    return pd.DataFrame(np.nanmean(windows, axis=2), index=shares.index, columns=shares.columns)
+
+
+def fz28_1_compute_metrics(df: pd.DataFrame, window: int = rolling_window) -> FZ28Metrics:
+    """
+    Computes the derived metrics of all months and all vehicle types at once
+    :param df: The FZ 28.1 aggregate (fz28_1_aggregated())
+    :param window: Number of months of the rolling shares
+    """
+    all_columns = fz28_1_all_columns()
+    values = df.reindex(columns=all_columns).to_numpy(dtype="float64", na_value=np.nan)
+    values = values.reshape(len(df), len(kfztypes), len(PowerType))
+
+    totals = np.nansum(values, axis=2)
+    group_values = np.stack([np.nansum(values[..., [list(PowerType).index(p) for p in members]], axis=2)
+                             for members in power_type_groups.values()], axis=2)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        shares = values / np.where(totals > 0, totals, np.nan)[..., np.newaxis]
+        group_shares = group_values / group_values.sum(axis=2, keepdims=True)
+
+    shares = pd.DataFrame(shares.reshape(len(df), -1), index=df.index, columns=all_columns)
+    return FZ28Metrics(
+        totals=pd.DataFrame(totals, index=df.index, columns=pd.Index(kfztypes, name='Vehicle Type')),
+        shares=shares,
+        rolling_shares=fz28_1_rolling_shares(shares, window),
+        groups=pd.DataFrame(group_values.reshape(len(df), -1), index=df.index, columns=fz28_1_group_columns()),
+        group_shares=pd.DataFrame(group_shares.reshape(len(df), -1), index=df.index, columns=fz28_1_group_columns()),
+        window=window,
+    )
+
+
+def fz28_1_read_metrics_cache(file: str, window: int) -> Tuple[Optional[FZ28Metrics], Dict[str, str]]:
+    """
+    :return: The cached metrics (None if there is no cache of the current schema version and window)
+             and the hashes of the aggregate rows they were computed from
+    """
+    import pyarrow.parquet as pq
+
+    if not os.path.exists(file):
+        return None, {}
+    parquet_file = pq.ParquetFile(file, memory_map=True)
+    metadata = parquet_file.schema_arrow.metadata or {}
+    if (metadata.get(b"schema_version") != str(cache_schema_version).encode()
+            or metadata.get(b"window") != str(window).encode()):
+        return None, {}
+
+    flat = parquet_file.read().to_pandas().set_index("date")
+    flat.index.name = None
+
+    def frame(metric: str, columns: pd.Index) -> pd.DataFrame:
+        names = [f"{metric}|{c}" if isinstance(c, str) else f"{metric}|{c[0]}|{c[1]}" for c in columns]
+        # columns without any data are not stored
+        result = flat.reindex(columns=names)
+        result.columns = columns
+        return result
+
+    all_columns, group_columns = fz28_1_all_columns(), fz28_1_group_columns()
+    return FZ28Metrics(
+        totals=frame("totals", pd.Index(kfztypes, name='Vehicle Type')),
+        shares=frame("shares", all_columns),
+        rolling_shares=frame("rolling_shares", all_columns).fillna(0.0),
+        groups=frame("groups", group_columns),
+        group_shares=frame("group_shares", group_columns),
+        window=window,
+    ), json.loads(metadata[b"rows"])
+
+
+def fz28_1_write_metrics_cache(file: str, metrics: FZ28Metrics, row_hashes: Dict[str, str]):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    frames = []
+    for metric in ["totals", "shares", "rolling_shares", "groups", "group_shares"]:
+        frame = getattr(metrics, metric)
+        # unpopulated columns are not stored (rolling shares without data are 0)
+        frame = frame.loc[:, frame.ne(0).any() if metric == "rolling_shares" else frame.notna().any()]
+        frame.columns = [f"{metric}|{c}" if isinstance(c, str) else f"{metric}|{c[0]}|{c[1]}" for c in frame.columns]
+        frames.append(frame)
+    flat = pd.concat(frames, axis=1)
+
+    table = pa.Table.from_pandas(flat.rename_axis("date").reset_index(), preserve_index=False)
+    table = table.replace_schema_metadata({
+        b"schema_version": str(cache_schema_version).encode(),
+        b"window": str(metrics.window).encode(),
+        b"rows": json.dumps(row_hashes, sort_keys=True).encode(),
+    })
+    pq.write_table(table, f"{file}.tmp", compression="zstd", use_dictionary=False, write_statistics=False)
+    os.replace(f"{file}.tmp", file)
+
+
+@stage('kba.metrics')
+def fz28_1_metrics(window: int = rolling_window, df: Optional[pd.DataFrame] = None) -> FZ28Metrics:
+    """
+    Gets the derived metrics of the FZ 28.1 aggregate (from file cache if available):
+    Totals per vehicle type, the shares of all power types and their rolling means, and the power_type_groups.
+    The cache records a hash of every month of the aggregate, only new or changed months are computed
+    (and the rolling shares within window months of them).
+    :param window: Number of months of the rolling shares
+    :param df: The FZ 28.1 aggregate (default: fz28_1_aggregated())
+    :return: The derived metrics, indexed by month like the aggregate
+    """
+    if df is None:
+        df = fz28_1_aggregated()
+    df = df.reindex(columns=fz28_1_all_columns()).sort_index()
+    file = f"{datafolder}/fz28_1_metrics.parquet"
+
+    values = df.to_numpy(dtype="float64", na_value=np.nan)
+    row_hashes = {str(month): hashlib.blake2b(row.tobytes(), digest_size=8).hexdigest() for month, row in zip(df.index, values)}
+    cached, cached_hashes = fz28_1_read_metrics_cache(file, window)
+    changed = [month for month, key in zip(df.index, row_hashes) if cached_hashes.get(key) != row_hashes[key]]
+    count('cache_hits', len(row_hashes) - len(changed))
+    count('cache_misses', len(changed))
+    if cached is not None and not changed and cached_hashes.keys() == row_hashes.keys():
+        return cached
+
+    if cached is None or not cached_hashes.keys() <= row_hashes.keys():
+        # no cache or months were removed
+        metrics = fz28_1_compute_metrics(df, window)
+    else:
+        new = fz28_1_compute_metrics(df.loc[changed], window)
+
+        def merge(old_frame: pd.DataFrame, new_frame: pd.DataFrame) -> pd.DataFrame:
+            return pd.concat([old_frame.drop(index=new_frame.index, errors="ignore"), new_frame]).reindex(df.index)
+
+        shares = merge(cached.shares, new.shares)
+        # the rolling mean of a month depends on at most window months around it,
+        # so only recompute it from window months before the first change
+        first = df.index.get_loc(changed[0])
+        start = max(first - 2 * window, 0)
+        rolling = fz28_1_rolling_shares(shares.iloc[start:], window)
+        if start > 0:
+            rolling = pd.concat([cached.rolling_shares.iloc[:first - window], rolling.iloc[first - window - start:]])
+        metrics = FZ28Metrics(
+            totals=merge(cached.totals, new.totals),
+            shares=shares,
+            rolling_shares=rolling,
+            groups=merge(cached.groups, new.groups),
+            group_shares=merge(cached.group_shares, new.group_shares),
+            window=window,
+        )
+
+    fz28_1_write_metrics_cache(file, metrics, row_hashes)
+    return metrics
+
+
+def _fetch_jobs(files: List[str], only_new: bool) -> List[Tuple[str, str]]:
+    """ :return: (url, destination path) of the files to download """
     all_files = os.listdir(datafolder)
 
     fs = len(files)
-    ndown = 0
+    jobs = []
     for i, file in enumerate(files):
         # get only the filename of the file
         fname = file.split("/")[-1].split("?")[0]
-        print(f"File ({i}/{fs}): {fname} .. ", end="")
         if fname in all_files and only_new:
-            print(f"already exists.")
+            print(f"File ({i}/{fs}): {fname} .. already exists.")
+            count('files_skipped')
             continue
+        jobs.append((file, f"{datafolder}/{fname}"))
+    return jobs
 
-        print(f"downloading .. ", end="")
-        try:
-            response = requests.get(file)
-            response.raise_for_status()
-            with open(f"{datafolder}/{fname}", "wb") as f:
-                f.write(response.content)
-            print(f"Success")
-            ndown += 1
-        except requests.RequestException as e:
-            print(f"Error fetching file data: {e}")
-            continue
+
+def _report_download(fname: str, result) -> bool:
+    """
+    Prints and counts the result of a download (see download_utils.download_all())
+    :return: Whether the content of the file was downloaded
+    """
+    if isinstance(result, Exception):
+        print(f"File {fname} .. Error fetching file data: {result}")
+        count('download_errors')
+    elif result is None:
+        print(f"File {fname} .. not modified.")
+        count('cache_hits')
+    else:
+        print(f"File {fname} .. downloaded ({result} bytes).")
+        count('bytes_downloaded', result)
+        return True
+    return False
+
+
+@stage('kba.fetch')
+def fetch_all(files: List[str], only_new: bool = True, max_workers: int = 4) -> int:
+    """
+    Downloads the given files concurrently into the datafolder.
+    Files that have been downloaded before are requested conditionally, so unchanged files are not transferred again.
+    :param files: URLs of the files
+    :param only_new: Skip files that already exist locally
+    :param max_workers: Maximum number of concurrent downloads
+    :return: Number of files whose content was downloaded
+    """
+    jobs = _fetch_jobs(files, only_new)
+    results = download_all(jobs, f"{datafolder}/fz28_downloads.json", max_workers)
+    ndown = sum(_report_download(os.path.basename(path), result) for (_, path), result in zip(jobs, results))
+    count('files_downloaded', ndown)
 
     return ndown
 
 
-def ensure_up_to_date(force: bool = False):
+@stage('kba.pipeline')
+def fz28_fetch_and_aggregate(files: List[str], only_new: bool = True, max_workers: int = 4,
+                             parse_workers: Optional[int] = None) -> Tuple[int, Dict[str, Exception]]:
+    """
+    Downloads the given files and parses them while the downloads go on: every finished download is handed to a
+    parsing worker right away (after the downloaded files the cached aggregates do not contain yet),
+    and the parsed rows are merged into the cached aggregates of all fz28_tables.
+    Finished downloads wait in a bounded queue (download_queue_size), so downloads pause while the parsers lag behind.
+    A file that fails to download or to parse (fz28_file_errors()) is reported and left out of the aggregates without
+    aborting the others, it is downloaded again by the next update (see fz28_quarantine()).
+    Other errors (eg. of the environment) abort the batch without moving any file.
+    :param files: URLs of the files
+    :param only_new: Skip downloading files that already exist locally
+    :param max_workers: Maximum number of concurrent downloads
+    :param parse_workers: Number of parsing processes (default: all cores if parallel_min_files or more files may need
+                          parsing, 1 parses in this process)
+    :return: Number of files whose content was downloaded and {file name: error} of the files that failed
+    """
+    jobs = _fetch_jobs(files, only_new)
+    downloading = {os.path.basename(path) for _, path in jobs}
+    local = [fname for fname in fz28_stale_files() if fname not in downloading]
+    cached = {name: fz28_cached_files(fz28_cache_file(name)) or {} for name in fz28_tables}
+    if parse_workers is None:
+        parse_workers = (os.cpu_count() or 1) if len(jobs) + len(local) >= parallel_min_files else 1
+
+    finished = queue.Queue(maxsize=download_queue_size)
+    cancelled = threading.Event()
+    failure = []
+
+    def on_done(i: int, result):
+        # blocks the download thread while the queue is full
+        if not cancelled.is_set():
+            finished.put((os.path.basename(jobs[i][1]), result))
+
+    def produce():
+        try:
+            download_all(jobs, f"{datafolder}/fz28_downloads.json", max_workers, on_done=on_done)
+        except Exception as e:
+            failure.append(e)
+        finally:
+            finished.put(None)
+
+    rows = {name: [] for name in fz28_tables}
+    file_hashes = {}
+    errors = {}
+    running = {}
+
+    def failed(fname: str, e: Exception):
+        fz28_quarantine(fname, e)
+        errors[fname] = e
+
+    def parsed(fname: str, digest: str, tables: Dict[str, pd.DataFrame]):
+        for name, df in tables.items():
+            rows[name].append(df)
+        # only files parsed successfully are recorded in the caches
+        file_hashes[fname] = digest
+        count('files_parsed')
+
+    def collect(limit: int):
+        # wait until at most limit files are being parsed
+        while len(running) > limit:
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                fname, digest = running.pop(future)
+                try:
+                    parsed(fname, digest, future.result())
+                except fz28_file_errors() as e:
+                    failed(fname, e)
+
+    def parse(fname: str):
+        try:
+            digest = file_hash(f"{datafolder}/{fname}")
+            tables = [name for name in fz28_tables if cached[name].get(fname) != digest]
+            if not tables:
+                return
+            if executor is None:
+                parsed(fname, digest, _parse_tables((fname, tables), datafolder))
+                return
+            running[executor.submit(_parse_tables, (fname, tables), datafolder)] = fname, digest
+        except fz28_file_errors() as e:
+            failed(fname, e)
+        # a few files queued per process keep the processes busy without holding back the results
+        collect(2 * parse_workers)
+
+    ndown = 0
+    executor = ProcessPoolExecutor(max_workers=parse_workers) if parse_workers > 1 else None
+    producer = threading.Thread(target=produce, name="kba-downloads", daemon=True)
+    producer.start()
+    try:
+        for fname in local:
+            parse(fname)
+        for fname, result in iter(finished.get, None):
+            ndown += _report_download(fname, result)
+            if isinstance(result, Exception):
+                errors[fname] = result
+            else:
+                parse(fname)
+        collect(0)
+    finally:
+        cancelled.set()
+        # unblock the download thread if parsing was interrupted
+        while producer.is_alive():
+            try:
+                finished.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        if executor is not None:
+            for future in running:
+                future.cancel()
+            executor.shutdown()
+    count('files_downloaded', ndown)
+
+    for name, table_rows in rows.items():
+        if table_rows or not cached[name]:
+            fz28_merge_into_cache(name, pd.concat(table_rows) if table_rows else None, file_hashes)
+    if errors:
+        print(f"{len(errors)} file(s) failed, downloading them again with the next update: {', '.join(sorted(errors))}")
+    if failure:
+        raise failure[0]
+    return ndown, errors
+
+
+@stage('kba.update')
+def ensure_up_to_date(force: bool = False) -> Dict[str, Exception]:
     """
     Ensure all the latest files have been downloaded.
     By default only checks for new files once a day.
-    :return:
+    :return: {file name: error} of the files that failed to download or to parse (see fz28_fetch_and_aggregate())
     """
+    errors = {}
     _, time = newest_file_in_dir(datafolder, "fz28_*.xlsx")
     if force or datetime.datetime.fromtimestamp(time) < datetime.datetime.now() - datetime.timedelta(days=1):
         all_fz28 = fz28_get_list()
-        # make sure at least the latest file is freshly downloaded
-        if fetch_all(all_fz28) <= 0:
-            fetch_all(all_fz28[:1], False)
-
-    # ensure aggregate is up-to-date
-    fz28_1_aggregated()
+        # make sure at least the latest file is fresh (a conditional request, so this is cheap if it did not change)
+        # the new files are parsed into the aggregates while the downloads go on
+        ndown, errors = fz28_fetch_and_aggregate(all_fz28)
+        if ndown <= 0:
+            errors.update(fz28_fetch_and_aggregate(all_fz28[:1], False)[1])
+
+    else:
+        # ensure the aggregates are up-to-date (they are only loaded if files changed), every file is hashed once
+        file_hashes = {fname: file_hash(f"{datafolder}/{fname}") for fname in fz28_files()}
+        stale = fz28_stale_files(file_hashes)
+        if stale:
+            fz28_update_aggregates(file_hashes=file_hashes, files=stale)
+    return errors
 
 
 if __name__ == "__main__":
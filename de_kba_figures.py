@@ -0,0 +1,259 @@
+"""
+Figures of the German new heavy vehicle registrations (KBA FZ 28.1), see de_electric_truck_development.ipynb
+"""
+
+from typing import Dict, List, Optional, Tuple, Union
+
+import pandas as pd
+import matplotlib.pyplot as plt
+
+import de_kba_datagrabber as kba
+import figure_pipeline
+from figure_pipeline import Figure
+from plot_utils import draw_pie
+from utils import PowerType
+
+figures_folder = 'figures/de'
+
+heavy_vehicle_types = ['Kraftomnibusse', 'Lastkraftwagen', 'Sattelzugmaschinen']
+
+monthy_average_window = 6
+
+pie_months = 6
+""" Number of months averaged in the fuel share pie charts """
+
+# Default display order and colors of the pie charts (can contain all fuel types; "Other" will be added/updated dynamically)
+pie_order = ['BEV', 'PHEV', 'FCEV', 'HY', 'HEV', 'Gas', 'Other', 'ICE']
+pie_colors = {
+    'BEV': '#2ecc71',
+    'PHEV': '#f39c12',
+    'FCEV': '#3498db',
+    'HY': '#54a8fb',
+    'HEV': '#e74c3c',
+    'Gas': '#f35c12',
+    'Other': '#c7c7c7',
+    'ICE': '#9e9e9e'
+}
+fuel_names = {
+#    'FCEV': 'Fuel-Cell',
+#    'HY': 'Hydrogen',
+    'HEV': 'Hybrid',
+#    'Gas': 'Gas (LPG / CNG)',
+}
+
+
+def bev_shares(metrics: kba.FZ28Metrics, types: List[str], ma_window: int = 1) -> pd.DataFrame:
+    """
+    :return: The BEV share of the vehicle types (month x vehicle type), averaged over ma_window months if ma_window > 1
+    """
+    if ma_window <= 1:
+        return metrics.shares.xs(PowerType.BEV, axis=1, level=1)[types].fillna(0.0)
+    assert metrics.window == ma_window, f"The metrics are averaged over {metrics.window} months, not {ma_window}"
+    return metrics.rolling_shares.xs(PowerType.BEV, axis=1, level=1)[types]
+
+
+def group_data(metrics: kba.FZ28Metrics, kfztype: str) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    :return: The registrations and shares of the power type groups of a vehicle type
+    """
+    return metrics.groups[kfztype], metrics.group_shares[kfztype]
+
+
+def plot_bev_share(bev_share: pd.DataFrame, ma_window: int = 1) -> plt.Figure:
+    """
+    :param bev_share: BEV share of every vehicle type to plot (see bev_shares())
+    :param ma_window: Number of months the shares are averaged over
+    """
+    fig, ax = plt.subplots(figsize=(12, 6))
+    for t in bev_share.columns:
+        series_to_plot = bev_share[t].sort_index() * 100
+        label = f'{t}' if ma_window <= 1 else f'{t} (MA {ma_window})'
+
+        # Plot line and add last value label
+        line, = ax.plot(series_to_plot.index, series_to_plot.values, label=label)
+        valid_series = series_to_plot.dropna()
+        if not valid_series.empty:
+            x_last = valid_series.index[-1]
+            y_last = float(valid_series.iloc[-1])
+            # Place the label slightly to the right of the last point
+            try:
+                x_text = x_last + pd.Timedelta(days=15)
+            except Exception:
+                x_text = x_last
+            ax.text(x_text, y_last, f'{y_last:.1f}%', color=line.get_color(), ha='left', va='center', fontsize=9)
+
+    ax.set_ylim(0, 50)
+
+    ax.set_ylabel('BEV share (%)')
+    ax.set_xlabel('Time')
+    ax.set_title('BEV Share Over Time' if ma_window <= 1 else f'BEV Share Over Time (Averaged {ma_window} months)')
+    ax.legend(title='Vehicle Type')
+    ax.spines['top'].set_visible(False)
+    ax.spines['left'].set_visible(False)
+    ax.spines['right'].set_visible(False)
+    # Add minor ticks for the first couple of percentage points
+    ax.yaxis.set_minor_locator(plt.FixedLocator([1, 2, 3, 4, 5, 15, 25]))
+    ax.tick_params(axis='y', which='both', length=0)
+    ax.grid(axis='y', which='major', linestyle='--', alpha=0.6)
+    ax.grid(axis='y', which='minor', linestyle='--', alpha=0.3)
+
+    ax.yaxis.set_label_position("right")
+    ax.yaxis.tick_right()
+
+    fig.tight_layout()
+    return fig
+
+
+def plot_by_power_type(data: Tuple[pd.DataFrame, pd.DataFrame], kfztype: str) -> plt.Figure:
+    """
+    :param data: Registrations and shares of the power type groups of the vehicle type (see group_data())
+    :param kfztype: The vehicle type
+    """
+    order = ['BEV', 'PHEV', 'Gas', 'Other', 'ICE']
+    colors = {
+        'BEV': '#2ecc71',  # green
+        'PHEV': '#f39c12',  # orange
+        'Gas': '#f35c12',  # orange
+        'Other': '#c7c7c7', # dark grey
+        'ICE': '#9e9e9e' # grey
+    }
+
+    groups, group_shares = data
+    df_plot2 = groups.sort_index().reindex(columns=order).rename_axis(columns=None)
+    df_share2 = group_shares.sort_index().reindex(columns=order).rename_axis(columns=None)
+
+    color_list = [colors[k] for k in order]
+
+    fig2, axes2 = plt.subplots(2, 1, figsize=(12, 10), sharex=True)
+
+    df_plot2.plot(kind='area', stacked=True, ax=axes2[0], color=color_list)
+    axes2[0].set_title(f'{kfztype} by Powertype over Time (Absolute)')
+    axes2[0].set_ylabel('Value')
+    axes2[0].yaxis.set_label_position("right")
+    axes2[0].yaxis.tick_right()
+
+    df_share2.plot(kind='area', stacked=True, ax=axes2[1], color=color_list)
+    axes2[1].set_title(f'{kfztype} by Powertype over Time (Fraction)')
+    axes2[1].set_xlabel('Time')
+    axes2[1].set_ylabel('Share (0–1)')
+    axes2[1].set_ylim(0, 1)
+    axes2[1].yaxis.set_label_position("right")
+    axes2[1].yaxis.tick_right()
+
+    fig2.tight_layout()
+    return fig2
+
+
+def plot_fuel_share_pie(ax, shares: pd.DataFrame, vtype: str, n_months=3, others_threshold=0.005, order=pie_order,
+                        colors=pie_colors):
+    sub = shares.xs(vtype, axis=1, level=0, drop_level=True).sort_index()
+
+    # Map Enum columns to string names once
+    get_name = lambda c: getattr(c, 'value', str(c))
+    df_share = sub.rename(columns={c: get_name(c) for c in sub.columns}).fillna(0.0)
+
+    # Average the monthly shares over the last n months
+    recent = df_share.tail(n_months)
+
+    avg_share = recent.mean(axis=0).fillna(0.0)
+
+    # Dynamically group categories below threshold into "Other"
+    small_cats = [k for k, v in avg_share.items() if k != 'Other' and v < others_threshold]
+    if small_cats:
+        other_value = avg_share.get('Other', 0.0) + float(avg_share[small_cats].sum())
+        avg_share = avg_share.drop(index=small_cats)
+        if other_value > 0:
+            avg_share['Other'] = other_value
+
+    # If no data or all zeros, hide this plot
+    if avg_share.sum() <= 0:
+        ax.axis('off')
+        ax.set_title(f'{vtype}: No data')
+        return
+
+    # Reorder according to desired order, then append any remaining categories
+    ordered_keys = [k for k in order if k in avg_share.index] + [k for k in avg_share.index if k not in order]
+    avg_share = avg_share[ordered_keys]
+
+    for k,v in fuel_names.items():
+        if k in colors:
+            colors[v] = colors[k]
+
+    draw_pie(
+        ax=ax,
+        values=avg_share.values,
+        labels=list(map(lambda n: fuel_names.get(n, n), avg_share.index)),
+        colors_map=colors,
+        autopct_threshold=0.02,
+        startangle=90,
+        counterclock=False,
+        pctdistance=0.72,
+        radius=0.95,
+        label_line_radius=0.98,
+        label_radius=1.05,
+        label_vertical_aligned=False,
+        text_fontsize=9,
+        show=False
+    )
+
+    start_m = recent.index.min().strftime('%B')
+    end_m = recent.index.max().strftime('%B')
+    months_label = start_m if start_m == end_m else f'{start_m} - {end_m}'
+
+    ax.set_title(f'{vtype} ({months_label})')
+    ax.margins(0.15, 0.15)
+    ax.axis('scaled')
+
+
+def plot_fuel_share_pies(shares: pd.DataFrame, vehicle_types: List[str], n_months: int = 1) -> plt.Figure:
+    """ Fuel share pie charts of all vehicle types in one figure, averaged over the last n_months of the power type shares """
+    fig, axes = plt.subplots(1, len(vehicle_types), figsize=(4 * len(vehicle_types) + 2, 6))
+    if len(vehicle_types) == 1:
+        axes = [axes]
+
+    for ax, vt in zip(axes, vehicle_types):
+        plot_fuel_share_pie(ax, shares, vt, n_months=n_months)
+
+    fig.tight_layout()
+    return fig
+
+
+def figures(metrics: kba.FZ28Metrics) -> List[Figure]:
+    """
+    :param metrics: The derived metrics of the FZ 28.1 aggregate (kba.fz28_1_metrics(monthy_average_window))
+    :return: All figure files of the German heavy vehicle registrations, each with the data slice it is drawn from
+    """
+    heavy_vehicle_shares = metrics.shares[heavy_vehicle_types].sort_index()
+    return [
+        Figure(f'{figures_folder}/heavy_vehicles_bev_share_plot_{monthy_average_window}m_running_average', plot_bev_share,
+               bev_shares(metrics, heavy_vehicle_types, monthy_average_window), dict(ma_window=monthy_average_window)),
+        Figure(f'{figures_folder}/heavy_vehicles_bev_share_plot',
+               plot_bev_share, bev_shares(metrics, heavy_vehicle_types)),
+        Figure(f'{figures_folder}/lastkraftwagen_by_fueltype_plot',
+               plot_by_power_type, group_data(metrics, 'Lastkraftwagen'), dict(kfztype='Lastkraftwagen')),
+        Figure(f'{figures_folder}/sattelzugmaschinen_by_fueltype_plot',
+               plot_by_power_type, group_data(metrics, 'Sattelzugmaschinen'), dict(kfztype='Sattelzugmaschinen')),
+        # the pie charts only depend on the last months
+        Figure(f'{figures_folder}/heavy_vehicles_by_fueltype_latest_month',
+               plot_fuel_share_pies, heavy_vehicle_shares.tail(1), dict(vehicle_types=heavy_vehicle_types, n_months=1)),
+        Figure(f'{figures_folder}/heavy_vehicles_by_fueltype_last_{pie_months}_months',
+               plot_fuel_share_pies, heavy_vehicle_shares.tail(pie_months),
+               dict(vehicle_types=heavy_vehicle_types, n_months=pie_months)),
+    ]
+
+
+def render_all(jobs: Optional[int] = None, force: bool = False, update: bool = False) -> Dict[str, Union[str, Exception]]:
+    """
+    Renders all figures of the German heavy vehicle registrations whose data or code changed
+    :param jobs: Number of rendering processes (default: all cores)
+    :param force: Redraw all figures
+    :param update: Download new KBA data first
+    :return: The result of render_figures()
+    """
+    if update:
+        kba.ensure_up_to_date()
+    return figure_pipeline.render_figures(figures(kba.fz28_1_metrics(monthy_average_window)), jobs, force)
+
+
+if __name__ == "__main__":
+    figure_pipeline.main('Renders the figures of the German new heavy vehicle registrations', render_all)
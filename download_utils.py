@@ -0,0 +1,148 @@
+"""
+Downloading of data files:
+All downloads share one keep-alive session, run concurrently in a bounded thread pool,
+stream into a temporary file that is atomically renamed once complete
+and are conditional on the ETag / Last-Modified of the previous download, which are kept in a small manifest.
+requests is only imported once the first download starts.
+"""
+
+from __future__ import annotations
+
+import json
+import os
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING, Callable, Dict, List, Optional, Tuple, Union
+
+if TYPE_CHECKING:
+    import requests
+
+max_connections = 8
+""" Size of the connection pool of the shared session (upper bound for concurrent downloads) """
+
+_umask = os.umask(0)
+os.umask(_umask)
+""" The umask of the process, read once (reading it means setting it, which is not thread-safe) """
+
+_session: Optional[requests.Session] = None
+_session_lock = threading.Lock()
+
+
+def session() -> requests.Session:
+    """
+    :return: The shared keep-alive session used for all requests
+    """
+    import requests
+    from requests.adapters import HTTPAdapter
+
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=max_connections, pool_maxsize=max_connections)
+            _session.mount("http://", adapter)
+            _session.mount("https://", adapter)
+        return _session
+
+
+def load_manifest(manifest_file: str) -> Dict[str, dict]:
+    """
+    :return: The download manifest (file name -> url, ETag, Last-Modified), empty if it does not exist yet
+    """
+    if not os.path.exists(manifest_file):
+        return {}
+    with open(manifest_file, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def save_manifest(manifest_file: str, manifest: Dict[str, dict]):
+    with open(manifest_file, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+
+
+def download(url: str, path: str, cache_entry: Optional[dict] = None, timeout: float = 60) -> Tuple[Optional[int], dict]:
+    """
+    Downloads url to path, writing into a temporary file that replaces path only once the download is complete
+    :param url: URL to download
+    :param path: Destination file
+    :param cache_entry: Manifest entry of the previous download, makes the request conditional if path still exists
+    :param timeout: Timeout for connecting and for every read
+    :return: Number of bytes written (None if the server reported the file as not modified) and the new manifest entry
+    """
+    headers = {}
+    if cache_entry and cache_entry.get("url") == url and os.path.exists(path):
+        if cache_entry.get("etag"):
+            headers["If-None-Match"] = cache_entry["etag"]
+        if cache_entry.get("last_modified"):
+            headers["If-Modified-Since"] = cache_entry["last_modified"]
+
+    with session().get(url, headers=headers, stream=True, timeout=timeout) as response:
+        if response.status_code == 304:
+            # the local file is confirmed to be up-to-date
+            os.utime(path)
+            return None, cache_entry
+        response.raise_for_status()
+
+        folder, name = os.path.split(path)
+        fd, tmp_path = tempfile.mkstemp(prefix=f".{name}.", suffix=".part", dir=folder or ".")
+        try:
+            nbytes = 0
+            with os.fdopen(fd, "wb") as f:
+                for chunk in response.iter_content(chunk_size=1 << 16):
+                    f.write(chunk)
+                    nbytes += len(chunk)
+            # mkstemp creates the file readable by the owner only, give the file the usual permissions
+            os.chmod(tmp_path, 0o666 & ~_umask)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+        entry = {"url": url, "etag": response.headers.get("ETag"), "last_modified": response.headers.get("Last-Modified")}
+        return nbytes, entry
+
+
+def download_all(jobs: List[Tuple[str, str]], manifest_file: str, max_workers: int = 4, conditional: bool = True,
+                 on_done: Optional[Callable[[int, Union[Optional[int], Exception]], None]] = None
+                 ) -> List[Union[Optional[int], Exception]]:
+    """
+    Downloads several files concurrently
+    :param jobs: (url, destination path) of every file
+    :param manifest_file: JSON file storing the ETag / Last-Modified of every downloaded file
+    :param max_workers: Maximum number of concurrent downloads
+    :param conditional: Use conditional requests for files that have been downloaded before
+    :param on_done: Called with the index of the job and its result as soon as a download finished, in the download
+                    thread (so a blocking callback, eg. putting into a bounded queue, holds back further downloads)
+    :return: For every job (in order) the result of download() or the exception it raised
+    """
+    manifest = load_manifest(manifest_file)
+    manifest_lock = threading.Lock()
+
+    def job(url: str, path: str) -> Union[Optional[int], Exception]:
+        fname = os.path.basename(path)
+        try:
+            nbytes, entry = download(url, path, manifest.get(fname) if conditional else None)
+        except Exception as e:
+            # eg. a network, HTTP or disk error, reported without aborting the other downloads
+            return e
+        with manifest_lock:
+            manifest[fname] = entry
+        return nbytes
+
+    def notify(i: int, url: str, path: str) -> Union[Optional[int], Exception]:
+        result = job(url, path)
+        if on_done is not None:
+            on_done(i, result)
+        return result
+
+    if not jobs:
+        return []
+
+    try:
+        with ThreadPoolExecutor(max_workers=min(max_workers, max_connections, len(jobs))) as executor:
+            results = list(executor.map(lambda j: notify(j[0], *j[1]), enumerate(jobs)))
+    finally:
+        # keep the entries of the finished downloads even if the batch was interrupted
+        save_manifest(manifest_file, manifest)
+    return results
@@ -0,0 +1,233 @@
+"""
+Change-aware rendering of figure files:
+Every figure is a function of a slice of the data. A figure is only redrawn if the hash of its data slice
+and of its plotting code changed since it was last written, it is drawn once and saved to all formats.
+The figures are rendered concurrently in worker processes using the non-interactive Agg backend.
+"""
+
+from __future__ import annotations
+
+import argparse
+import contextlib
+import hashlib
+import inspect
+import json
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Tuple, Union
+
+from instrumentation import count, stage
+from utils import lazy_import
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+pd = lazy_import('pandas')
+
+formats = ('png', 'svg')
+""" All figures are written in these formats """
+
+dpi = 300
+
+state_file = 'figures/figure_hashes.json'
+""" Records the hash every figure file was last rendered with, shared by all figure modules """
+
+_repo_dir = os.path.dirname(os.path.abspath(__file__))
+
+
+class Figure(NamedTuple):
+    path: str
+    """ Output file path without extension """
+    draw: Callable[..., Any]
+    """ Module level function drawing the figure from data (and kwargs) and returning the matplotlib figure """
+    data: Any
+    """ The data slice the figure is drawn from """
+    kwargs: Dict[str, Any] = {}
+    """ Further arguments of draw """
+
+
+def _update_hash(h, obj):
+    if isinstance(obj, (pd.DataFrame, pd.Series)):
+        columns = obj.columns.tolist() if isinstance(obj, pd.DataFrame) else obj.name
+        h.update(repr((type(obj).__name__, obj.shape, obj.index.names, columns, [str(t) for t in obj.dtypes]
+                       if isinstance(obj, pd.DataFrame) else str(obj.dtype))).encode('utf-8'))
+        h.update(pd.util.hash_pandas_object(obj, index=True).to_numpy().tobytes())
+    elif isinstance(obj, (list, tuple)):
+        h.update(f'{type(obj).__name__}{len(obj)}'.encode('utf-8'))
+        for item in obj:
+            _update_hash(h, item)
+    elif isinstance(obj, dict):
+        h.update(f'dict{len(obj)}'.encode('utf-8'))
+        for key in sorted(obj, key=repr):
+            _update_hash(h, key)
+            _update_hash(h, obj[key])
+    else:
+        h.update(repr(obj).encode('utf-8'))
+
+
+def code_files(func: Callable) -> List[str]:
+    """
+    :return: The source files of the module defining func and of all modules of this repository it uses
+    """
+    module = sys.modules[func.__module__]
+    files = {inspect.getsourcefile(module)}
+    for value in vars(module).values():
+        used = inspect.getmodule(value)
+        used_file = getattr(used, '__file__', None)
+        if used_file and os.path.dirname(os.path.abspath(used_file)) == _repo_dir:
+            files.add(inspect.getsourcefile(used))
+    return sorted(files)
+
+
+def figure_hash(figure: Figure) -> str:
+    """
+    :return: Hash over the data, arguments and plotting code of a figure
+    """
+    h = hashlib.sha256()
+    _update_hash(h, (figure.draw.__qualname__, figure.kwargs, formats, dpi))
+    for file in code_files(figure.draw):
+        with open(file, 'rb') as f:
+            h.update(f.read())
+    _update_hash(h, figure.data)
+    return h.hexdigest()
+
+
+def _init_worker():
+    import matplotlib
+    matplotlib.use('Agg')
+    # stable ids in SVG files, so unchanged figures give identical files
+    matplotlib.rcParams['svg.hashsalt'] = 'figure_pipeline'
+
+
+def render(figure: Figure) -> str:
+    """
+    Draws a figure and writes it in all formats
+    :return: The path of the figure
+    """
+    import matplotlib.pyplot as plt
+
+    with stage('figure', figure=figure.path):
+        fig = figure.draw(figure.data, **figure.kwargs)
+        try:
+            os.makedirs(os.path.dirname(figure.path) or '.', exist_ok=True)
+            for fmt in formats:
+                fig.savefig(f'{figure.path}.{fmt}', dpi=dpi, bbox_inches='tight',
+                            metadata={'Date': None} if fmt == 'svg' else None)
+                count('bytes_written', os.path.getsize(f'{figure.path}.{fmt}'))
+        finally:
+            plt.close(fig)
+    return figure.path
+
+
+@contextlib.contextmanager
+def _state_lock():
+    """ Locks the state file against other processes (eg. a figure module and a notebook rendering concurrently) """
+    os.makedirs(os.path.dirname(state_file) or '.', exist_ok=True)
+    with open(f'{state_file}.lock', 'a+b') as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        else:
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_UN)
+            else:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+def _read_state() -> Dict[str, str]:
+    if not os.path.exists(state_file):
+        return {}
+    with open(state_file, 'r', encoding='utf-8') as f:
+        try:
+            return json.load(f)
+        except json.JSONDecodeError as e:
+            # the affected figures are just rendered again
+            print(f'Ignoring broken {state_file}: {e}')
+            return {}
+
+
+def load_state() -> Dict[str, str]:
+    with _state_lock():
+        return _read_state()
+
+
+def save_state(updates: Dict[str, str]):
+    """
+    Records the hashes of rendered figures: the entries are merged into the current state file under a lock,
+    so concurrent runs keep each other's entries, and the file is replaced at once, so it is never left truncated
+    """
+    with _state_lock():
+        state = {**_read_state(), **updates}
+        with open(f'{state_file}.tmp', 'w', encoding='utf-8') as f:
+            json.dump(state, f, indent=1, sort_keys=True)
+        os.replace(f'{state_file}.tmp', state_file)
+
+
+def render_figures(figures: List[Figure], jobs: Optional[int] = None,
+                   force: bool = False) -> Dict[str, Union[str, Exception]]:
+    """
+    Renders all figures whose data or code changed since they were last written
+    :param figures: The figures to render
+    :param jobs: Number of rendering processes (default: all cores)
+    :param force: Render all figures, even unchanged ones
+    :return: For every figure path 'rendered', 'unchanged' or the exception raised while rendering it
+    """
+    state = load_state()
+    rendered_hashes: Dict[str, str] = {}
+    results: Dict[str, Union[str, Exception]] = {}
+    to_render: List[Tuple[Figure, str]] = []
+    for figure in figures:
+        digest = figure_hash(figure)
+        if not force and state.get(figure.path) == digest and all(os.path.exists(f'{figure.path}.{fmt}') for fmt in formats):
+            results[figure.path] = 'unchanged'
+        else:
+            to_render.append((figure, digest))
+
+    if to_render:
+        jobs = max(1, min(jobs or os.cpu_count() or 1, len(to_render)))
+        with ProcessPoolExecutor(max_workers=jobs, initializer=_init_worker) as executor:
+            futures = [(executor.submit(render, figure), figure, digest) for figure, digest in to_render]
+            for future, figure, digest in futures:
+                try:
+                    future.result()
+                    results[figure.path] = 'rendered'
+                    rendered_hashes[figure.path] = digest
+                except Exception as e:
+                    results[figure.path] = e
+        save_state(rendered_hashes)
+
+    rendered = sum(1 for r in results.values() if r == 'rendered')
+    failed = sum(1 for r in results.values() if isinstance(r, Exception))
+    count('cache_hits', len(results) - len(to_render))
+    count('cache_misses', len(to_render))
+    count('figures_failed', failed)
+    print(f'Figures: {rendered} rendered, {len(results) - rendered - failed} unchanged, {failed} failed')
+    return results
+
+
+def main(description: str, render_all: Callable[..., Dict[str, Union[str, Exception]]]):
+    """
+    Command line entry point of a figure module
+    :param description: Description of the figures
+    :param render_all: Function rendering the figures, called with jobs, force and update
+    """
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('--jobs', type=int, default=None, help='Number of rendering processes (default: all cores)')
+    parser.add_argument('--force', action='store_true', help='Redraw all figures, even unchanged ones')
+    parser.add_argument('--update', action='store_true', help='Update the data before rendering')
+    args = parser.parse_args()
+
+    results = render_all(jobs=args.jobs, force=args.force, update=args.update)
+    failed = {path: e for path, e in results.items() if isinstance(e, Exception)}
+    for path, e in failed.items():
+        print(f'Failed to render {path}: {e!r}')
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,346 @@
+"""
+Fleet (stock) turnover simulation: how the sales shares of electric vehicles turn into their share of the fleet
+
+Every year's sales form a cohort, which shrinks with the survival curve of its vehicle class (Weibull curves
+with an assumed mean lifetime). The fleet of a year is the sum of all surviving cohorts, so the stock is a
+convolution of the sales with the survival curve:
+
+    stock[t] = sum over ages a of sales[t - a] * survival[a] + survivors of the fleet before the first year
+
+The convolution runs over dense (scenario x entity x year) arrays, so all countries / vehicle classes and all
+scenarios (projected sales share paths, eg. from s_curve_scenarios()) are simulated at once.
+Shares are fractions, like in world_ev_data.
+"""
+
+import math
+from typing import Dict, NamedTuple, Optional, Sequence, Union
+
+import numpy as np
+import pandas as pd
+
+import de_kba_datagrabber as kba
+from s_curves import SCurveFit, s_curve
+from utils import PowerType
+from world_ev_data import (DATE, ENTITY, ENTITY_TYPE, SALES_BEVS, SALES_EVS, SALES_SHARE_BEVS, SALES_SHARE_EVS,
+                           SALES_TOTAL, STOCK_BEVS, STOCK_EVS, STOCK_SHARE_BEVS, STOCK_SHARE_EVS, EntityType, load_ev_data)
+
+mean_lifetimes = {
+    'Cars': 15.,
+    'Kraftomnibusse': 12.,
+    'Lastkraftwagen': 14.,
+    'Sattelzugmaschinen': 8.,
+}
+"""
+Assumed mean time in years a vehicle stays in the fleet, by vehicle class (entities not listed here are countries,
+whose fleets are cars). Semi-trailer tractors leave the German fleet early, many are exported after a few years.
+"""
+
+weibull_shape = 3.
+""" Shape of the Weibull survival curves (larger values concentrate the scrapping around the mean lifetime) """
+
+max_age = 60
+""" Oldest age of the survival curves, older vehicles are considered scrapped """
+
+kba_vehicle_classes = ['Kraftomnibusse', 'Lastkraftwagen', 'Sattelzugmaschinen']
+""" The heavy vehicle classes of the KBA FZ 28.1 registrations that are simulated """
+
+stock_columns = {
+    SALES_SHARE_EVS: (STOCK_EVS, STOCK_SHARE_EVS),
+    SALES_SHARE_BEVS: (STOCK_BEVS, STOCK_SHARE_BEVS),
+}
+""" Sales share column -> the observed stock and stock share columns of the same vehicles """
+
+fleet_columns = [SALES_TOTAL, SALES_SHARE_EVS, SALES_SHARE_BEVS, STOCK_EVS, STOCK_SHARE_EVS, STOCK_BEVS, STOCK_SHARE_BEVS]
+""" The columns of the world EV data the simulation and its validation use """
+
+
+class FleetSimulation(NamedTuple):
+    stock: pd.DataFrame
+    """ Total fleet at the end of every year, years x entity """
+    electric_stock: pd.DataFrame
+    """ Fleet of the vehicles of the simulated sales share, years x (scenario, entity) """
+    stock_share: pd.DataFrame
+    """ Their share of the total fleet, years x (scenario, entity) """
+    sales: pd.DataFrame
+    """ Total sales (observed and projected), years x entity """
+    survival: pd.DataFrame
+    """ Survival curves, age x entity """
+
+
+def weibull_survival(ages: np.ndarray, mean_lifetime, shape=weibull_shape) -> np.ndarray:
+    """
+    Share of the vehicles still in the fleet at the given ages (the parameters broadcast against ages)
+    :param ages: Years since the registration
+    :param mean_lifetime: Mean time in years until the vehicles are scrapped
+    :param shape: Weibull shape parameter
+    """
+    shape = np.asarray(shape, dtype='float64')
+    scale = np.asarray(mean_lifetime, dtype='float64') / np.vectorize(math.gamma)(1 + 1 / shape)
+    return np.exp(-(np.asarray(ages, dtype='float64') / scale) ** shape)
+
+
+def survival_curves(entities: Sequence[str], mean_lifetime: Union[None, float, Dict[str, float]] = None,
+                    shape: float = weibull_shape) -> pd.DataFrame:
+    """
+    :param entities: The countries / vehicle classes
+    :param mean_lifetime: Mean lifetime of all entities or {entity: mean lifetime} (default: mean_lifetimes)
+    :return: Survival curves of the entities at the end of every year, age x entity
+             (vehicles of age 0 are registered in the same year, on average half a year before its end)
+    """
+    if mean_lifetime is None or isinstance(mean_lifetime, dict):
+        lifetimes = {**mean_lifetimes, **(mean_lifetime or {})}
+        lifetime = np.array([lifetimes.get(e, mean_lifetimes['Cars']) for e in entities])
+    else:
+        lifetime = np.full(len(entities), float(mean_lifetime))
+    ages = np.arange(max_age + 1)
+    return pd.DataFrame(weibull_survival(ages[:, np.newaxis] + 0.5, lifetime, shape),
+                        index=pd.RangeIndex(max_age + 1, name='age'), columns=pd.Index(entities, name='entity'))
+
+
+def cohort_stock(sales: np.ndarray, survival: np.ndarray) -> np.ndarray:
+    """
+    The surviving vehicles of all cohorts: stock[..., t] = sum over a of sales[..., t - a] * survival[..., a]
+    :param sales: Sales per year (..., years), the leading dimensions (eg. scenario, entity) broadcast against survival
+    :param survival: Survival curves (..., ages)
+    :return: The stock at the end of every year (..., years)
+    """
+    years = sales.shape[-1]
+    stock = np.zeros(np.broadcast_shapes(sales.shape[:-1], survival.shape[:-1]) + (years,))
+    for age in range(min(years, survival.shape[-1])):
+        stock[..., age:] += survival[..., [age]] * sales[..., :years - age]
+    return stock
+
+
+def observed_total_stock(data: pd.DataFrame) -> pd.Series:
+    """ The total fleet implied by the observed EV stock and EV stock share, indexed like data """
+    share = data[STOCK_SHARE_EVS] if STOCK_SHARE_EVS in data else pd.Series(np.nan, index=data.index)
+    stock = data[STOCK_EVS] if STOCK_EVS in data else pd.Series(np.nan, index=data.index)
+    return stock / share.where(share > 0)
+
+
+def _dense(data: pd.DataFrame, column: str, years: pd.Index, entities: pd.Index) -> np.ndarray:
+    """ A column of (entity, year) indexed data as entity x year array """
+    if column not in data:
+        return np.full((len(entities), len(years)), np.nan)
+    return data[column].unstack(level=0).reindex(index=years, columns=entities).to_numpy(
+        dtype='float64', na_value=np.nan).T
+
+
+def _dense_total_stock(data: pd.DataFrame, years: pd.Index, entities: pd.Index) -> np.ndarray:
+    """ The observed total fleet as entity x year array """
+    return _dense(data.assign(total_stock=observed_total_stock(data)), 'total_stock', years, entities)
+
+
+def _scenario_shares(scenarios: pd.DataFrame, years: pd.Index, entities: pd.Index):
+    """
+    :return: The scenario keys and the projected shares as scenario x entity x year array
+    """
+    # rows are the scenarios, columns (year, entity)
+    frame = scenarios.T.unstack(level=-1)
+    frame = frame.reindex(columns=pd.MultiIndex.from_product([years, entities]))
+    values = frame.to_numpy(dtype='float64', na_value=np.nan).reshape(len(frame), len(years), len(entities))
+    return frame.index, values.transpose(0, 2, 1)
+
+
+def simulate_fleet(data: pd.DataFrame, scenarios: Optional[pd.DataFrame] = None, share_column: str = SALES_SHARE_EVS,
+                   sales_growth: float = 0., mean_lifetime: Union[None, float, Dict[str, float]] = None,
+                   shape: float = weibull_shape) -> FleetSimulation:
+    """
+    Simulates the fleets of all entities for all scenarios at once
+    :param data: Yearly data indexed by (entity, year) with the total sales (SALES_TOTAL) and the sales share
+                 (share_column) like owid_data() or kba_fleet_data(), optionally with the observed EV stock and
+                 EV stock share to calibrate the fleet before the first year (else it is assumed to be in steady state
+                 with the sales of the first year)
+    :param scenarios: Projected sales shares, years x (scenario levels..., entity), eg. from s_curve_scenarios(),
+                      the observed shares take precedence (default: only simulate the observed years)
+    :param share_column: The sales share column of the simulated vehicles, eg. SALES_SHARE_EVS or SALES_SHARE_BEVS
+    :param sales_growth: Yearly growth of the total sales after the last observed year
+    :param mean_lifetime: Mean lifetime of all entities or {entity: mean lifetime} (default: mean_lifetimes)
+    :param shape: Weibull shape of the survival curves
+    :return: The total fleet and the fleet and fleet share of the simulated vehicles of every scenario
+    """
+    entities = data.index.get_level_values(0).unique()
+    observed_years = data.index.get_level_values(1)
+    last_year = int(observed_years.max())
+    if scenarios is not None:
+        last_year = max(last_year, int(scenarios.index.max()))
+    years = pd.RangeIndex(int(observed_years.min()), last_year + 1, name=data.index.names[1])
+    t = np.arange(len(years))
+
+    # total sales: interpolate gaps, continue after the last observed year with the sales growth
+    sales = data[SALES_TOTAL].unstack(level=0).reindex(index=years, columns=entities)
+    sales = sales.interpolate(limit_area='inside')
+    first = sales.notna().to_numpy().argmax(axis=0)
+    last = len(years) - 1 - sales.notna().to_numpy()[::-1].argmax(axis=0)
+    sales = sales.ffill().to_numpy(dtype='float64', na_value=np.nan).T
+    sales = sales * np.where(t > last[:, np.newaxis], (1 + sales_growth) ** (t - last[:, np.newaxis]), 1.)
+    started = t >= first[:, np.newaxis]
+    sales = np.where(started, sales, 0.)
+
+    # shares: the observed ones, in between interpolated, after them the scenarios (or the last observed share)
+    observed = data[share_column].unstack(level=0).reindex(index=years, columns=entities)
+    observed = observed.interpolate(limit_area='inside').to_numpy(dtype='float64', na_value=np.nan).T
+    if scenarios is None:
+        keys, projected = pd.Index(['observed'], name='scenario'), np.full((1,) + observed.shape, np.nan)
+    else:
+        keys, projected = _scenario_shares(scenarios, years, entities)
+    after_observed = t > (len(years) - 1 - np.isfinite(observed)[:, ::-1].argmax(axis=1))[:, np.newaxis]
+    shares = np.where(np.isfinite(observed) | ~after_observed, observed, projected)
+    shares = pd.DataFrame(shares.reshape(-1, len(years)).T).ffill().fillna(0.).to_numpy().T.reshape(shares.shape)
+
+    survival = survival_curves(entities, mean_lifetime, shape)
+    curves = survival.to_numpy().T
+    stock = cohort_stock(sales, curves)
+    electric_stock = cohort_stock(sales * shares, curves)
+
+    # the fleet before the first year (only non-electric vehicles) with constant yearly sales b,
+    # of which sum over a > n of b * survival[a] are left n years after the first year
+    remaining = np.concatenate([np.cumsum(curves[:, ::-1], axis=1)[:, ::-1], np.zeros((len(entities), 1))], axis=1)
+    remaining = np.take_along_axis(remaining, np.clip(t - first[:, np.newaxis] + 1, 0, max_age + 1), axis=1)
+    before = sales[np.arange(len(entities)), first]
+    # calibrate to the last observed total fleet
+    observed_stock = _dense_total_stock(data, years, entities)
+    observed_stock = np.where(started, observed_stock, np.nan)
+    has_observed = np.isfinite(observed_stock).any(axis=1)
+    calibration_year = len(years) - 1 - np.isfinite(observed_stock)[:, ::-1].argmax(axis=1)
+    index = np.arange(len(entities)), calibration_year
+    with np.errstate(divide='ignore', invalid='ignore'):
+        calibrated = (observed_stock[index] - stock[index]) / remaining[index]
+    before = np.where(has_observed & np.isfinite(calibrated), np.maximum(calibrated, 0.), before)
+    stock += before[:, np.newaxis] * remaining
+
+    stock = np.where(started, stock, np.nan)
+    electric_stock = np.where(started, electric_stock, np.nan)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        stock_share = electric_stock / stock
+
+    tuples = [(k if isinstance(k, tuple) else (k,)) + (e,) for k in keys for e in entities]
+    columns = pd.MultiIndex.from_tuples(tuples, names=list(keys.names) + [entities.name])
+
+    def frame(values: np.ndarray, columns) -> pd.DataFrame:
+        return pd.DataFrame(values.reshape(-1, len(years)).T, index=years, columns=columns)
+
+    return FleetSimulation(
+        stock=frame(stock, entities),
+        electric_stock=frame(electric_stock, columns),
+        stock_share=frame(stock_share, columns),
+        sales=frame(np.where(started, sales, np.nan), entities),
+        survival=survival,
+    )
+
+
+def s_curve_scenarios(fit: SCurveFit, series: str = 'EV', saturation: Sequence[Optional[float]] = (None,),
+                      midpoint_shift: Sequence[float] = (0,), steepness_factor: Sequence[float] = (1,)) -> pd.DataFrame:
+    """
+    Sales share scenarios from S-curves fitted to the yearly shares (s_curves.fit_s_curves() with shares as fractions),
+    every combination of the parameter variations is one scenario
+    :param fit: The fitted curves
+    :param series: The share series of the fit to use
+    :param saturation: Saturation shares (None: the fitted saturation, labelled 'fitted')
+    :param midpoint_shift: Years to shift the midpoints by
+    :param steepness_factor: Factors of the fitted steepness
+    :return: The projected sales shares, years x (saturation, midpoint_shift, steepness_factor, entity)
+    """
+    assert fit.freq is None, "The fleet simulation needs curves fitted to yearly shares"
+    params = fit.params.loc[series]
+    scenarios = pd.MultiIndex.from_product(
+        [['fitted' if s is None else s for s in saturation], midpoint_shift, steepness_factor],
+        names=['saturation', 'midpoint_shift', 'steepness_factor'])
+    saturations = np.stack([params['saturation'].to_numpy(dtype='float64') if s == 'fitted' else np.full(len(params), s)
+                            for s in scenarios.get_level_values(0)])
+    midpoints = params['midpoint'].to_numpy() + scenarios.get_level_values(1).to_numpy(dtype='float64')[:, np.newaxis]
+    steepness = params['steepness'].to_numpy() * scenarios.get_level_values(2).to_numpy(dtype='float64')[:, np.newaxis]
+    years = fit.forecast.index
+    # scenario x entity x year
+    shares = s_curve(fit.model, years.to_numpy(dtype='float64'), saturations[..., np.newaxis],
+                     steepness[..., np.newaxis], midpoints[..., np.newaxis])
+    columns = pd.MultiIndex.from_tuples([k + (e,) for k in scenarios for e in params.index],
+                                        names=list(scenarios.names) + [params.index.name])
+    return pd.DataFrame(shares.reshape(-1, len(years)).T, index=years, columns=columns)
+
+
+def validate_fleet(simulation: FleetSimulation, data: pd.DataFrame,
+                   share_column: str = SALES_SHARE_EVS) -> pd.DataFrame:
+    """
+    Compares the simulated fleets of the observed years with the observed stock columns (eg. of owid_data())
+    :param simulation: The simulation of data
+    :param data: The data indexed by (entity, year) the simulation was run with
+    :param share_column: The sales share column that was simulated
+    :return: Per entity with observations: the number of years with observed stock, the mean absolute relative error
+             of the simulated stock, the RMSE of the stock share and the observed and simulated stock share of the last
+             observed year
+    """
+    stock_column, _ = stock_columns[share_column]
+    entities, years = simulation.stock.columns, simulation.stock.index
+    # the observed years are the same in all scenarios, so take the first one
+    simulated = simulation.electric_stock.iloc[:, :len(entities)].to_numpy()
+    simulated_share = simulation.stock_share.iloc[:, :len(entities)].to_numpy()
+    observed = _dense(data, stock_column, years, entities).T
+    total = _dense_total_stock(data, years, entities).T
+    observed_share = observed / total
+
+    valid = np.isfinite(observed) & (observed > 0) & np.isfinite(simulated)
+    share_valid = valid & np.isfinite(observed_share)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        relative_error = np.abs(simulated / observed - 1)
+        last = len(years) - 1 - share_valid[::-1].argmax(axis=0)
+        index = last, np.arange(len(entities))
+        result = pd.DataFrame({
+            'points': valid.sum(axis=0),
+            'stock_error': np.where(valid, relative_error, 0.).sum(axis=0) / valid.sum(axis=0),
+            'stock_share_rmse': np.sqrt(np.where(share_valid, (simulated_share - observed_share) ** 2, 0.).sum(axis=0)
+                                        / share_valid.sum(axis=0)),
+            'last_year': np.where(share_valid.any(axis=0), years[last], np.nan),
+            'observed_stock_share': np.where(share_valid.any(axis=0), observed_share[index], np.nan),
+            'simulated_stock_share': np.where(share_valid.any(axis=0), simulated_share[index], np.nan),
+        }, index=entities)
+    return result.loc[result['points'] > 0]
+
+
+def kba_fleet_data(df: Optional[pd.DataFrame] = None,
+                   vehicle_classes: Sequence[str] = kba_vehicle_classes) -> pd.DataFrame:
+    """
+    The yearly registrations of the KBA heavy vehicle classes, in the columns of the world EV data
+    (KBA publishes no stock numbers, so their fleets before the first year are assumed to be in steady state)
+    :param df: The FZ 28.1 aggregate (default: fz28_1_aggregated())
+    :param vehicle_classes: The vehicle classes (entities of the result)
+    :return: The data of the complete years indexed by (entity, year)
+    """
+    if df is None:
+        df = kba.fz28_1_aggregated()
+    year = pd.DatetimeIndex(df.index).year
+    months = pd.Series(1, index=year).groupby(level=0).size()
+    complete = months.index[months == 12]
+
+    registrations = df.reindex(columns=pd.MultiIndex.from_product([list(vehicle_classes), list(PowerType)]))
+    yearly = registrations.groupby(year).sum(min_count=1).loc[complete]
+    # the power types in FZ 28.1 partition the registrations, their sub types (eg. ICE_D) are not filled
+    totals = yearly.T.groupby(level=0).sum().T
+    bevs = yearly.xs(PowerType.BEV, axis=1, level=1).fillna(0)
+    evs = bevs + sum(yearly.xs(p, axis=1, level=1).fillna(0) for p in [PowerType.PHEV, PowerType.FCEV])
+
+    result = pd.DataFrame({
+        SALES_TOTAL: totals.stack(),
+        SALES_EVS: evs.stack(),
+        SALES_BEVS: bevs.stack(),
+    })
+    result.index = result.index.swaplevel().set_names(['entity', 'year'])
+    result = result.sort_index()
+    result[SALES_SHARE_EVS] = result[SALES_EVS] / result[SALES_TOTAL]
+    result[SALES_SHARE_BEVS] = result[SALES_BEVS] / result[SALES_TOTAL]
+    return result
+
+
+def world_fleet_data(source: str = 'consolidated_yearly', entities: Optional[Sequence[str]] = None) -> pd.DataFrame:
+    """
+    The yearly car sales and stock of the countries in the merged EV data (only the columns the simulation uses are read)
+    :param source: The source of the merged data, eg. 'owid' (default: the consolidated yearly data)
+    :param entities: Only these countries (default: all)
+    :return: The data indexed by (entity, year), like kba_fleet_data()
+    """
+    data = load_ev_data(fleet_columns, entities, [source]).loc[source]
+    data = data.loc[data[ENTITY_TYPE] == EntityType.Country].drop(columns=ENTITY_TYPE)
+    data.index = pd.MultiIndex.from_arrays([data.index.get_level_values(ENTITY),
+                                            data.index.get_level_values(DATE).year.astype('int64')],
+                                           names=['entity', 'year'])
+    return data
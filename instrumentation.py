@@ -0,0 +1,191 @@
+"""
+Stage-level instrumentation of the update run
+
+The work is split into named stages (stage() context manager), stages can be nested.
+Every finished stage appends one JSON line to the run log with its wall time, the peak RSS of the process,
+its enclosing stage and the counters incremented directly within it (count(), eg. bytes downloaded, files parsed,
+cache hits / misses; the counters of nested stages are only recorded with the nested stage).
+Worker processes inherit the run log through environment variables, so stages running in a process pool
+(eg. figure rendering, notebook execution) are logged too, tagged with their process id.
+
+Optionally the stages are profiled with cProfile, one .prof file per stage (view it eg. with snakeviz or pstats).
+Profiles cannot be nested, so by default only the outermost stages of every process are profiled
+(a profile does not cover the work of worker processes), or only the stages given by name.
+
+Without an active run (start_run()) the stages record nothing and cost next to nothing.
+"""
+
+import contextlib
+import cProfile
+import datetime
+import json
+import os
+import sys
+import threading
+import time
+from typing import Any, Dict, Iterable, List, Optional
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+log_env = 'INSTRUMENTATION_LOG'
+""" Environment variable holding the path of the JSON lines run log (instrumentation is disabled if unset) """
+
+run_env = 'INSTRUMENTATION_RUN'
+""" Environment variable holding the id of the current run """
+
+profile_env = 'INSTRUMENTATION_PROFILE'
+""" Environment variable holding the folder of the profile dumps (profiling is disabled if unset) """
+
+profile_stages_env = 'INSTRUMENTATION_PROFILE_STAGES'
+""" Environment variable holding the comma separated names of the stages to profile (default: the outermost stages) """
+
+
+class _Stage:
+    __slots__ = ('name', 'counters')
+
+    def __init__(self, name: str):
+        self.name = name
+        self.counters: Dict[str, float] = {}
+
+
+_stack: List[_Stage] = []
+_lock = threading.Lock()
+_profiler: Optional[cProfile.Profile] = None
+_profile_count = 0
+_run_start = None
+
+
+def _after_fork():
+    # a forked worker inherits the open stages (so its stages name their parent), but not the active profiler
+    global _profiler
+    if _profiler is not None:
+        _profiler.disable()
+        _profiler = None
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork)
+
+
+def enabled() -> bool:
+    return bool(os.environ.get(log_env))
+
+
+def start_run(log_file: str, profile_dir: Optional[str] = None, profile_stages: Optional[Iterable[str]] = None) -> str:
+    """
+    Starts recording stages to a run log (also in worker processes started afterwards)
+    :param log_file: The JSON lines run log, new records are appended
+    :param profile_dir: Write a cProfile dump of every profiled stage into this folder (default: no profiling)
+    :param profile_stages: Names of the stages to profile (default: the stages not nested in another profiled stage)
+    :return: The id of the run
+    """
+    global _run_start
+    _run_start = time.perf_counter()
+    run = f"{datetime.datetime.now().strftime('%Y%m%dT%H%M%S')}-{os.getpid()}"
+    os.environ[log_env] = os.path.abspath(log_file)
+    os.environ[run_env] = run
+    if profile_dir:
+        os.makedirs(profile_dir, exist_ok=True)
+        os.environ[profile_env] = os.path.abspath(profile_dir)
+        os.environ[profile_stages_env] = ','.join(profile_stages or [])
+    else:
+        os.environ.pop(profile_env, None)
+    _write({'event': 'run', 'argv': sys.argv, 'start': time.time()})
+    return run
+
+
+def finish_run():
+    """ Records the total wall time and peak RSS of the run """
+    if enabled() and _run_start is not None:
+        _write({'event': 'run_end', 'wall_time': time.perf_counter() - _run_start, **peak_rss()})
+
+
+def peak_rss() -> Dict[str, Optional[int]]:
+    """
+    :return: The peak resident set size in bytes of this process and of its largest terminated child process so far
+             (None if not available on this platform)
+    """
+    if resource is None:
+        return {'peak_rss': None, 'peak_rss_children': None}
+    # ru_maxrss is in kilobytes on Linux, in bytes on macOS
+    scale = 1 if sys.platform == 'darwin' else 1024
+    return {'peak_rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale,
+            'peak_rss_children': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale}
+
+
+def count(counter: str, n: float = 1):
+    """
+    Increments a counter of the current stage (eg. 'bytes_downloaded', 'files_parsed', 'cache_hits', 'cache_misses')
+    """
+    if _stack:
+        with _lock:
+            counters = _stack[-1].counters
+            counters[counter] = counters.get(counter, 0) + n
+
+
+def _write(record: Dict[str, Any]):
+    line = json.dumps({'run': os.environ.get(run_env), 'pid': os.getpid(), **record}, default=str)
+    with _lock, open(os.environ[log_env], 'a', encoding='utf-8') as f:
+        f.write(line + '\n')
+
+
+def _start_profiler(name: str) -> Optional[cProfile.Profile]:
+    global _profiler
+    if _profiler is not None or not os.environ.get(profile_env):
+        return None
+    selected = [s for s in os.environ.get(profile_stages_env, '').split(',') if s]
+    if selected and name not in selected:
+        return None
+    _profiler = cProfile.Profile()
+    _profiler.enable()
+    return _profiler
+
+
+def _dump_profile(profiler: cProfile.Profile, name: str) -> str:
+    global _profiler, _profile_count
+    profiler.disable()
+    _profiler = None
+    _profile_count += 1
+    file = os.path.join(os.environ[profile_env],
+                        f"{os.environ.get(run_env)}_{os.getpid()}_{_profile_count:03d}_{name}.prof")
+    profiler.dump_stats(file)
+    return file
+
+
+@contextlib.contextmanager
+def stage(name: str, **info):
+    """
+    Records a stage of the run: wall time, peak RSS, the counters incremented within it and optionally a profile
+    :param name: Name of the stage, eg. 'kba.parse'
+    :param info: Further fields of the log record, eg. the file or figure the stage works on
+    """
+    if not enabled():
+        yield
+        return
+
+    current = _Stage(name)
+    parent = _stack[-1].name if _stack else None
+    _stack.append(current)
+    profiler = _start_profiler(name)
+    started = time.time()
+    start = time.perf_counter()
+    error = None
+    try:
+        yield
+    except BaseException as e:
+        error = repr(e)
+        raise
+    finally:
+        wall_time = time.perf_counter() - start
+        profile = _dump_profile(profiler, name) if profiler else None
+        _stack.pop()
+        record = {'event': 'stage', 'stage': name, 'parent': parent, 'start': started, 'wall_time': wall_time,
+                  **peak_rss(), **current.counters, **info}
+        if error:
+            record['error'] = error
+        if profile:
+            record['profile'] = profile
+        _write(record)
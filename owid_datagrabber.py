@@ -1,24 +1,20 @@
-import html
+from __future__ import annotations
+
 import os
 
-import requests
-import re
-import datetime
-import babel.dates
-import pandas as pd
-from typing import List
+from utils import lazy_import
 
-from utils import PowerType, intor, newest_file_in_dir
+pd = lazy_import('pandas')
 
 datafolder = "data/owid"
 
-
+electric_car_sales_file = os.path.join(datafolder, 'Electric car sales (IEA, 2025) - data.csv')
 
 
 def owid_electric_car_sales() -> pd.DataFrame:
     # https://docs.google.com/spreadsheets/d/e/2PACX-1vRDQ1EYuQPZasmbfjaghH9f65Nd2yLkQ0QAnOP5bp0LHWkwnjVcwssk6VFDhmWPOzjw2gCFyOqXBTQU/pub?output=csv
     # https://docs.google.com/spreadsheets/d/e/2PACX-1vRDQ1EYuQPZasmbfjaghH9f65Nd2yLkQ0QAnOP5bp0LHWkwnjVcwssk6VFDhmWPOzjw2gCFyOqXBTQU/pub?gid=409110122&output=csv
-    data = pd.read_csv(os.path.join(datafolder, 'Electric car sales (IEA, 2025) - data.csv'), index_col=['Entity', 'year'])
+    data = pd.read_csv(electric_car_sales_file, index_col=['Entity', 'year'])
     return data
 
 
@@ -0,0 +1,236 @@
+"""
+S-curve (logistic / Gompertz) adoption models of the share trajectories of all entities (countries)
+
+The curves of all entities and share series are fitted at once: the data is kept as a dense
+(share series x entity) x period matrix with a mask of the available values, and a batched Levenberg-Marquardt
+solve updates the parameters of all curves in every iteration (a 3x3 system per curve).
+Missing periods are simply masked out, so gaps in the data need no special handling.
+
+    logistic:  share(t) = saturation / (1 + exp(-steepness * (t - midpoint)))
+    gompertz:  share(t) = saturation * exp(-exp(-steepness * (t - midpoint)))
+
+The midpoint is the inflection point of the curve (half the saturation for the logistic curve, 1/e of it for Gompertz),
+the steepness is the growth rate per period. Shares are fractions, like in world_ev_data.
+"""
+
+from typing import Dict, NamedTuple, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+from pandas.tseries.frequencies import to_offset
+
+from world_ev_data import SALES_SHARE_BEVS, SALES_SHARE_EVS
+
+models = ('logistic', 'gompertz')
+
+min_points = 4
+""" Minimum number of data points of a series to fit a curve to it """
+
+_max_exponent = 50.
+""" Bound of the exponents in the curve functions, to avoid overflows far from the midpoint """
+
+
+class SCurveFit(NamedTuple):
+    params: pd.DataFrame
+    """ Per (share series, entity): midpoint, steepness, saturation, rmse, points (number of data points), converged """
+    forecast: pd.DataFrame
+    """ The fitted curves from the first period of the data to horizon periods after the last one,
+    columns are (share series, entity) """
+    model: str
+    """ 'logistic' or 'gompertz' """
+    freq: Optional[str]
+    """ Frequency of the periods (None for integer periods) """
+
+
+def s_curve(model: str, t: np.ndarray, saturation, steepness, midpoint) -> np.ndarray:
+    """
+    Evaluates S-curves (the parameters broadcast against t)
+    :param model: 'logistic' or 'gompertz'
+    :param t: Periods (in the units of the midpoint)
+    """
+    return _curve(model, np.asarray(t, dtype='float64'), saturation, steepness, midpoint)[0]
+
+
+def _curve(model: str, t: np.ndarray, saturation, steepness, midpoint, jacobian: bool = False):
+    """
+    :return: The curve values and (with jacobian) their derivatives by saturation, steepness and midpoint
+    """
+    dt = t - midpoint
+    x = np.clip(steepness * dt, -_max_exponent, _max_exponent)
+    if model == 'logistic':
+        s = 1 / (1 + np.exp(-x))
+        # derivative of s by the exponent
+        ds = s * (1 - s)
+    elif model == 'gompertz':
+        e = np.exp(-x)
+        s = np.exp(-e)
+        ds = s * e
+    else:
+        raise ValueError(f"Unknown model '{model}', use one of {models}")
+    if not jacobian:
+        return saturation * s, None
+    return saturation * s, np.stack([s, saturation * ds * dt, -saturation * ds * steepness], axis=-1)
+
+
+def _initial_params(model: str, t: np.ndarray, y: np.ndarray, mask: np.ndarray, saturation: np.ndarray) -> np.ndarray:
+    """
+    Start values from a weighted linear regression of the linearized curves, assuming the given saturation
+    :return: saturation, steepness, midpoint of every row
+    """
+    ratio = np.clip(np.nan_to_num(y) / saturation[:, np.newaxis], 1e-4, 1 - 1e-4)
+    z = np.log(ratio / (1 - ratio)) if model == 'logistic' else -np.log(-np.log(ratio))
+    # the linearization amplifies the noise of small shares, so weight them down
+    w = mask * ratio * (1 - ratio)
+    sw = np.maximum(w.sum(axis=1), 1e-12)
+    t_mean = (w * t).sum(axis=1) / sw
+    z_mean = (w * z).sum(axis=1) / sw
+    cov = (w * (t - t_mean[:, np.newaxis]) * (z - z_mean[:, np.newaxis])).sum(axis=1)
+    var = (w * (t - t_mean[:, np.newaxis]) ** 2).sum(axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        steepness = cov / var
+    valid = np.isfinite(steepness) & (steepness > 0)
+    steepness = np.where(valid, steepness, 0.5)
+    midpoint = np.where(valid, t_mean - z_mean / steepness, t[-1])
+    return np.column_stack([saturation, steepness, midpoint])
+
+
+def fit_curves(model: str, t: np.ndarray, y: np.ndarray, mask: np.ndarray, saturation: Optional[float] = None,
+               max_saturation: float = 1., max_iterations: int = 200,
+               tolerance: float = 1e-10) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Fits an S-curve to every row of y in one batched Levenberg-Marquardt solve
+    :param model: 'logistic' or 'gompertz'
+    :param t: The periods of the columns of y
+    :param y: 2-D array with one series per row
+    :param mask: Boolean array like y, the data points to fit (NaNs in y must be masked)
+    :param saturation: Fix the saturation to this value instead of fitting it (more robust for series in an early phase)
+    :param max_saturation: Upper bound of the fitted saturation
+    :param max_iterations: Stop after this many iterations even if not all fits converged
+    :param tolerance: A fit has converged when an iteration decreases its squared error by less than this fraction
+    :return: The parameters (rows x (saturation, steepness, midpoint)), the squared errors and whether the fits converged
+    """
+    t = np.asarray(t, dtype='float64')
+    mask = np.asarray(mask, dtype='float64')
+    y = np.where(mask > 0, y, 0.)
+    rows = len(y)
+    free = np.array([saturation is None, True, True])
+    start_saturation = np.full(rows, max_saturation if saturation is None else saturation, dtype='float64')
+    params = _initial_params(model, t, y, mask, start_saturation)
+    lower = np.array([1e-9, 1e-9, t[0] - 10 * len(t)])
+    upper = np.array([max_saturation, np.inf, t[-1] + 10 * len(t)])
+
+    def sse(p):
+        f, _ = _curve(model, t, p[:, [0]], p[:, [1]], p[:, [2]])
+        return (mask * (f - y) ** 2).sum(axis=1)
+
+    cost = sse(params)
+    damping = np.full(rows, 1e-3)
+    converged = np.zeros(rows, dtype=bool)
+    for _ in range(max_iterations):
+        f, jac = _curve(model, t, params[:, [0]], params[:, [1]], params[:, [2]], jacobian=True)
+        jm = jac * mask[..., np.newaxis]
+        gradient = np.einsum('rti,rt->ri', jm, f - y)
+        # parameters at a bound that the descent would push further out are held for this iteration
+        active = free & ~(((params <= lower) & (gradient > 0)) | ((params >= upper) & (gradient < 0)))
+        jac, jm, gradient = jac * active[:, np.newaxis, :], jm * active[:, np.newaxis, :], gradient * active
+        normal = np.einsum('rti,rtj->rij', jm, jac)
+        # Marquardt scaling of the damping, held parameters get an identity row so the systems stay regular
+        diagonal = np.einsum('rii->ri', normal)
+        damped = normal + (damping[:, np.newaxis] * diagonal + np.where(active, 1e-12, 1.))[..., np.newaxis] * np.eye(3)
+        step = np.linalg.solve(damped, -gradient[..., np.newaxis])[..., 0]
+        candidate = np.clip(params + step, lower, upper)
+        new_cost = sse(candidate)
+
+        better = (new_cost < cost) & ~converged
+        converged |= better & (cost - new_cost <= tolerance * cost)
+        # no step decreases the error any more
+        converged |= damping > 1e12
+        params = np.where(better[:, np.newaxis], candidate, params)
+        cost = np.where(better, new_cost, cost)
+        damping = np.where(better, np.maximum(damping / 10, 1e-12), damping * 10)
+        if converged.all():
+            break
+    return params, cost, converged
+
+
+def _period_positions(grid: pd.Index, freq: Optional[str]) -> np.ndarray:
+    """ Numeric time of the periods: the periods themselves for integer periods, else the number of periods since the first one """
+    if freq is None:
+        return grid.to_numpy(dtype='float64')
+    return np.arange(len(grid), dtype='float64')
+
+
+def _position_to_period(grid: pd.Index, freq: Optional[str], positions: np.ndarray):
+    """ Converts fractional period positions back to periods: fractional years or timestamps between the grid dates """
+    if freq is None:
+        return positions
+    offset = to_offset(freq)
+    whole = np.floor(np.nan_to_num(positions)).astype(int)
+    starts = pd.DatetimeIndex([grid[0] + int(n) * offset for n in whole])
+    ends = pd.DatetimeIndex([grid[0] + int(n + 1) * offset for n in whole])
+    return (starts + (ends - starts) * (np.nan_to_num(positions) - whole)).where(~np.isnan(positions))
+
+
+def fit_s_curves(data: pd.DataFrame, share_columns: Optional[Dict[str, str]] = None, model: str = 'logistic',
+                 freq: Optional[str] = None, saturation: Optional[float] = None, max_saturation: float = 1.,
+                 horizon: int = 20) -> SCurveFit:
+    """
+    Fits S-curves to the share trajectories of all entities
+    :param data: Data indexed by (entity, period) like for alignment.align_trajectories(),
+                 periods are consecutive integers (eg. years) or dates (see freq), shares are fractions
+    :param share_columns: {name: column} of the share series to fit (default: EV and BEV sales shares of owid_data())
+    :param model: 'logistic' or 'gompertz'
+    :param freq: Frequency of date periods, eg. 'MS' for monthly data dated to the start of the month
+    :param saturation: Fix the saturation to this share instead of fitting it
+    :param max_saturation: Upper bound of the fitted saturation
+    :param horizon: Number of periods after the last period of the data to forecast
+    :return: The parameters and the forecast of every (share series, entity),
+             the midpoints are fractional periods for integer periods and timestamps for date periods
+    """
+    if share_columns is None:
+        share_columns = {'EV': SALES_SHARE_EVS, 'BEV': SALES_SHARE_BEVS}
+
+    periods = data.index.get_level_values(1)
+    if freq is None:
+        grid = pd.RangeIndex(int(periods.min()), int(periods.max()) + 1, name=data.index.names[1])
+    else:
+        grid = pd.date_range(periods.min(), periods.max(), freq=freq, name=data.index.names[1])
+    shares = data[list(share_columns.values())].set_axis(list(share_columns), axis=1)
+    dense = shares.unstack(level=0).reindex(grid)
+    # rows are (share series, entity)
+    values = dense.to_numpy(dtype='float64', na_value=np.nan).T
+    columns = dense.columns.set_names(['series', data.index.names[0]])
+
+    t = _period_positions(grid, freq)
+    mask = np.isfinite(values)
+    points = mask.sum(axis=1)
+    fitted = points >= min_points
+    params, cost, converged = fit_curves(model, t, values[fitted], mask[fitted], saturation, max_saturation)
+
+    result = np.full((len(values), 3), np.nan)
+    result[fitted] = params
+    rmse = np.full(len(values), np.nan)
+    rmse[fitted] = np.sqrt(cost / points[fitted])
+    all_converged = np.zeros(len(values), dtype=bool)
+    all_converged[fitted] = converged
+
+    if freq is None:
+        forecast_grid = pd.RangeIndex(grid[0], grid[-1] + horizon + 1, name=grid.name)
+    else:
+        forecast_grid = pd.date_range(grid[0], periods=len(grid) + horizon, freq=freq, name=grid.name)
+    forecast_t = _period_positions(forecast_grid, freq)
+    forecast = s_curve(model, forecast_t[np.newaxis, :], result[:, [0]], result[:, [1]], result[:, [2]])
+
+    return SCurveFit(
+        params=pd.DataFrame({
+            'midpoint': _position_to_period(grid, freq, result[:, 2]),
+            'steepness': result[:, 1],
+            'saturation': result[:, 0],
+            'rmse': rmse,
+            'points': points,
+            'converged': all_converged,
+        }, index=columns),
+        forecast=pd.DataFrame(forecast.T, index=forecast_grid, columns=columns),
+        model=model,
+        freq=freq,
+    )
@@ -0,0 +1,57 @@
+"""
+Tests of the vectorized FZ 28.1 extraction against the cell by cell extraction it replaced
+"""
+
+import datetime
+
+import numpy as np
+import pandas as pd
+from openpyxl import load_workbook
+
+import de_kba_datagrabber as kba
+from benchmark import write_synthetic_fz28
+from utils import PowerType, intor, intor_array
+
+month = datetime.date(2024, 3, 1)
+
+
+def baseline_extract(data: pd.DataFrame) -> pd.DataFrame:
+    """ The FZ 28.1 extraction of fz28_1_do_aggregate() before it was vectorized, converting every cell with intor() """
+    df = pd.DataFrame(index=[month], columns=kba.fz28_1_all_columns())
+    for j, kfztype in enumerate(kba.kfztypes):
+        l = 6 + j
+        for power_type, column in kba.fz28_1_columns.items():
+            df.loc[month, (kfztype, power_type)] = intor(data.iat[l, column])
+        assert df.loc[month, kfztype].sum() == intor(data.iat[l, 3])
+        df.loc[month, (kfztype, PowerType.ICE)] = intor(data.iat[l, 2]) - intor(data.iat[l, 3])
+    return df
+
+
+def test_intor_array_matches_intor():
+    values = ["12.7", " 12 ", "-", "1e3", "", None, 12.7, -3.9, 5, True, np.nan, np.int64(7), "+4"]
+    assert intor_array(values).tolist() == [intor(v) for v in values]
+    assert intor_array(np.array([["3", "x"], [2.5, None]], dtype=object), -1).tolist() == [[3, -1], [2, -1]]
+
+
+def test_fz28_1_extract_numeric_strings(tmp_path):
+    columns = kba.fz28_1_all_columns()
+    registrations = pd.DataFrame(np.arange(len(columns)).reshape(1, -1) * 7 % 1000, index=[month], columns=columns)
+    write_synthetic_fz28(str(tmp_path), registrations)
+    file = tmp_path / "fz28_2024_03.xlsx"
+
+    # store some counts as text, like some published workbooks do: integers are read, decimals count as missing
+    wb = load_workbook(file)
+    ws = wb["FZ 28.1"]
+    first_row = 10
+    bev, fcev = kba.fz28_1_columns[PowerType.BEV] + 1, kba.fz28_1_columns[PowerType.FCEV] + 1
+    ws.cell(first_row, 3).value = str(ws.cell(first_row, 3).value)
+    ws.cell(first_row + 1, fcev).value = f" {ws.cell(first_row + 1, fcev).value} "
+    ws.cell(first_row + 2, 4).value = ws.cell(first_row + 2, 4).value - ws.cell(first_row + 2, bev).value
+    ws.cell(first_row + 2, bev).value = f"{ws.cell(first_row + 2, bev).value}.7"
+    wb.save(file)
+
+    data = kba.fz28_read_table(str(file), "FZ 28.1", nrows=kba.fz28_tables["FZ 28.1"].nrows)
+    assert isinstance(data.iat[8, bev - 1], str)
+    expected = baseline_extract(data)
+    pd.testing.assert_frame_equal(kba.fz28_1_extract(data, month), expected, check_dtype=False)
+    assert kba.fz28_1_extract(data, month).loc[month, (kba.kfztypes[2], PowerType.BEV)] == 0
@@ -0,0 +1,70 @@
+"""
+Tests of download_utils against a local HTTP server
+"""
+
+import os
+import stat
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import download_utils
+
+content = b"monthly data" * 1000
+etag = '"v1"'
+
+
+class Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != "/fz28_2024_01.xlsx":
+            self.send_error(404)
+            return
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("ETag", etag)
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{httpd.server_address[1]}"
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def test_download_all(server, tmp_path):
+    path = str(tmp_path / "fz28_2024_01.xlsx")
+    manifest = str(tmp_path / "manifest.json")
+    jobs = [(f"{server}/fz28_2024_01.xlsx", path)]
+
+    # 200: the file is written with the permissions of the umask and its ETag is recorded
+    assert download_utils.download_all(jobs, manifest) == [len(content)]
+    with open(path, "rb") as f:
+        assert f.read() == content
+    assert stat.S_IMODE(os.stat(path).st_mode) == 0o666 & ~download_utils._umask
+    assert download_utils.load_manifest(manifest)["fz28_2024_01.xlsx"]["etag"] == etag
+
+    # 304: the conditional request leaves the file alone
+    assert download_utils.download_all(jobs, manifest) == [None]
+    with open(path, "rb") as f:
+        assert f.read() == content
+
+    # 404: reported as the result of the job, the other jobs are not affected
+    missing = str(tmp_path / "fz28_2099_01.xlsx")
+    results = download_utils.download_all([(f"{server}/fz28_2099_01.xlsx", missing)] + jobs, manifest,
+                                          conditional=False)
+    assert isinstance(results[0], Exception) and results[1] == len(content)
+    assert not os.path.exists(missing)
+    assert not [f for f in os.listdir(tmp_path) if f.endswith(".part")]
@@ -1,61 +1,236 @@
 import de_kba_datagrabber as kba
-import subprocess
-import nbformat
-from nbconvert.preprocessors import ExecutePreprocessor
+import figure_pipeline
+import instrumentation
+from instrumentation import count, stage
+import argparse
 import glob
+import hashlib
+import importlib
+import json
 import os
-
-updated_data = []
-""" A list of (short name, match string, explanation) tuples that, if the match string appears in a notebook, will trigger a re-run of the notebook """
-
-
-
-##### Update all datasources
-
-# update kba data
-kba.ensure_up_to_date(True)
-
-# Get modified files from git
-git_output = subprocess.check_output(['git', 'diff', '--name-only', 'HEAD']).decode('utf-8')
-modified_files = git_output.splitlines()
-
-# If any of the kba FZ28 files have been updated, all notebooks using functions with fz28 in the name should be updated
-if any(file.startswith('data/de-kba/fz28') for file in modified_files):
-    updated_data.append(('KBA FZ28', 'fz28', 'Germany KBA FZ 28 alternative Antriebe'))
-
-print(f'Updated data: {updated_data}')
-
-
-
-##### Re-run all notebooks that use updated data
-
-if updated_data:
-    notebooks = glob.glob('**/*.ipynb', recursive=True)
-    for notebook_path in notebooks:
-        with open(notebook_path, 'r', encoding='utf-8') as f:
-            nb_content = f.read()
-
-            # Check if notebook uses updated data
-            if any(match in nb_content for (_, match, _) in updated_data):
-                print(f'Re-running notebook: {notebook_path}')
-                try:
-                    # Load and execute notebook
-                    f.seek(0)
-                    nb = nbformat.read(f, as_version=4)
-                    ep = ExecutePreprocessor(timeout=600, allow_errors=True)
-                    ep.preprocess(nb, {'metadata': {'path': os.path.dirname(notebook_path)}})
-
-                    # Save executed notebook
-                    # Note that this does not work if you run it directly in PyCharm because PyCharm steals the output plots and they wont get written to the resulting file anymore.
-                    # Thus, this needs to be run from the command line.
-                    with open(notebook_path, 'w', encoding='utf-8') as f:
-                        nbformat.write(nb, f)
-                except Exception as e:
-                    print(f'Error executing {notebook_path}: {e}')
-
-
-##### Write update info to log file
-with open('updated_data.log', 'w') as f:
-   f.write(', '.join(map((lambda d: d[0]), updated_data)))
-   f.write('\n')
-   f.write('\n'.join(map((lambda d: d[2]), updated_data)))
\ No newline at end of file
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+data_products = [
+    ('KBA FZ28', ['data/de-kba/fz28_1_aggregated.csv'], 'fz28', 'Germany KBA FZ 28 alternative Antriebe'),
+    ('OWID EV sales', ['data/owid/*.csv'], 'owid', 'OWID / IEA electric car sales'),
+]
+""" A list of (short name, file globs, match string, explanation) tuples of the data products the notebooks read.
+If a notebook does not declare its inputs, it reads every data product whose match string appears in its code """
+
+notebook_inputs = {
+    'de_electric_truck_development.ipynb': ['KBA FZ28'],
+    'world_ev_trajectories.ipynb': ['OWID EV sales'],
+    # development notebook, not re-run automatically
+    'normed_correlation_dev.ipynb': [],
+}
+""" The data products read by each notebook """
+
+figure_modules = {
+    'de_kba_figures': ['KBA FZ28'],
+    'world_ev_figures': ['OWID EV sales'],
+}
+""" Modules rendering the figure files (see figure_pipeline), each has a render_all() function, and the data products
+their figures are drawn from. A module (and its plotting libraries) is only loaded if its data or its code changed,
+its code are the files figure_pipeline.code_files() found when it last rendered (the module and the modules it uses) """
+
+state_file = 'update_state.json'
+""" Records the content hash of every data product, the input hashes every notebook was last executed with
+and the input and code hashes every figure module last rendered all its figures with """
+
+run_log = 'update_runs.jsonl'
+""" Structured log of the stages of every run (see instrumentation) """
+
+profile_folder = 'profiles'
+""" Folder of the cProfile dumps of the stages (with --profile) """
+
+
+def product_hash(file_globs) -> str:
+    """ Content hash over all files of a data product """
+    h = hashlib.sha256()
+    for file in sorted(f for g in file_globs for f in glob.glob(g)):
+        h.update(file.encode('utf-8'))
+        with open(file, 'rb') as f:
+            while chunk := f.read(1 << 20):
+                h.update(chunk)
+    return h.hexdigest()
+
+
+def detect_inputs(notebook_path):
+    """ The data products a notebook reads: declared in notebook_inputs or detected from its code cells """
+    if notebook_path in notebook_inputs:
+        return notebook_inputs[notebook_path]
+    import nbformat
+    with open(notebook_path, 'r', encoding='utf-8') as f:
+        nb = nbformat.read(f, as_version=4)
+    code = '\n'.join(c.source for c in nb.cells if c.cell_type == 'code')
+    return [name for (name, _, match, _) in data_products if match in code]
+
+
+def load_state():
+    if not os.path.exists(state_file):
+        return {'products': {}, 'notebooks': {}, 'figures': {}}
+    with open(state_file, 'r', encoding='utf-8') as f:
+        return {'figures': {}, **json.load(f)}
+
+
+def save_state(state):
+    with open(state_file, 'w', encoding='utf-8') as f:
+        json.dump(state, f, indent=1, sort_keys=True)
+
+
+def run_notebook(notebook_path):
+    """
+    Executes a notebook in its own kernel and saves it with its outputs
+    :return: (status, duration in seconds, error message) where status is 'ok', 'cell errors' or 'failed'
+    """
+    # only needed for the optional notebook execution
+    import nbformat
+    from nbconvert.preprocessors import ExecutePreprocessor
+
+    start = time.perf_counter()
+    try:
+        with stage('notebook', notebook=notebook_path):
+            # Load and execute notebook
+            with open(notebook_path, 'r', encoding='utf-8') as f:
+                nb = nbformat.read(f, as_version=4)
+            ep = ExecutePreprocessor(timeout=600, allow_errors=True)
+            ep.preprocess(nb, {'metadata': {'path': os.path.dirname(notebook_path)}})
+
+            # Save executed notebook
+            # Note that this does not work if you run it directly in PyCharm because PyCharm steals the output plots and they wont get written to the resulting file anymore.
+            # Thus, this needs to be run from the command line.
+            with open(notebook_path, 'w', encoding='utf-8') as f:
+                nbformat.write(nb, f)
+
+        errors = [o for c in nb.cells if c.cell_type == 'code' for o in c.get('outputs', []) if o.output_type == 'error']
+        if errors:
+            return 'cell errors', time.perf_counter() - start, f'{errors[0].ename}: {errors[0].evalue}'
+        return 'ok', time.perf_counter() - start, ''
+    except Exception as e:
+        return 'failed', time.perf_counter() - start, str(e)
+
+
+def run_notebooks(notebook_paths, jobs):
+    """
+    Executes independent notebooks concurrently, each in a separate process with its own kernel.
+    A failing notebook does not affect the others.
+    :return: {notebook path: (status, duration, error message)}
+    """
+    results = {}
+    with ProcessPoolExecutor(max_workers=max(1, min(jobs, len(notebook_paths)))) as executor:
+        futures = {executor.submit(run_notebook, path): path for path in notebook_paths}
+        for future in as_completed(futures):
+            path = futures[future]
+            try:
+                results[path] = future.result()
+            except Exception as e:
+                # eg. the worker process died
+                results[path] = ('failed', 0.0, str(e))
+            status, duration, error = results[path]
+            print(f'Finished notebook: {path} ({status} in {duration:.1f}s){f": {error}" if error else ""}')
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Updates all data sources and renders the figures whose data changed')
+    parser.add_argument('--jobs', type=int, default=os.cpu_count() or 1,
+                        help='Maximum number of processes rendering figures / notebooks executed concurrently')
+    parser.add_argument('--notebooks', action='store_true',
+                        help='Also re-run the notebooks whose input data changed (needs a Jupyter kernel)')
+    parser.add_argument('--run-log', default=run_log, help='JSON lines log of the timings and counters of all stages')
+    parser.add_argument('--profile', nargs='?', const='', default=None, metavar='STAGES',
+                        help=f'Write a cProfile dump per stage into {profile_folder}/, '
+                             f'optionally only of the comma separated stages (eg. kba.parse,figure)')
+    args = parser.parse_args()
+
+    instrumentation.start_run(args.run_log, profile_folder if args.profile is not None else None,
+                              args.profile.split(',') if args.profile else None)
+    state = load_state()
+
+    ##### Update all datasources
+
+    # update kba data, files that fail are left out (and reported below)
+    kba_errors = kba.ensure_up_to_date(True)
+
+    with stage('products.hash'):
+        hashes = {name: product_hash(file_globs) for (name, file_globs, _, _) in data_products}
+    updated_data = [d for d in data_products if state['products'].get(d[0]) != hashes[d[0]]]
+    state['products'] = hashes
+
+    print(f'Updated data: {[d[0] for d in updated_data]}')
+
+    ##### Render all figures whose data or code changed
+
+    figure_results = {}
+    for module_name, inputs in figure_modules.items():
+        last_render = state['figures'].get(module_name, {})
+        code_files = last_render.get('code_files') or [f'{module_name}.py']
+        current = {'inputs': {name: hashes[name] for name in inputs}, 'code': product_hash(code_files)}
+        try:
+            with stage('figures', module=module_name):
+                if ({key: last_render.get(key) for key in current} == current
+                        and all(os.path.exists(f'{path}.{fmt}') for path in last_render['figures'] for fmt in figure_pipeline.formats)):
+                    count('cache_hits', len(last_render['figures']))
+                    figure_results.update({path: 'unchanged' for path in last_render['figures']})
+                    continue
+                module = importlib.import_module(module_name)
+                results = module.render_all(jobs=args.jobs)
+                figure_results.update(results)
+                if not any(isinstance(result, Exception) for result in results.values()):
+                    code_files = [os.path.relpath(f) for f in figure_pipeline.code_files(module.render_all)]
+                    state['figures'][module_name] = {**current, 'code': product_hash(code_files),
+                                                     'code_files': code_files, 'figures': sorted(results)}
+        except Exception as e:
+            # eg. the data could not be loaded, the other figures are still rendered
+            figure_results[module_name] = e
+
+    ##### Optionally re-run all notebooks whose input data changed since their last execution
+
+    notebook_paths = sorted(glob.glob('**/*.ipynb', recursive=True)) if args.notebooks else []
+    to_run = {}
+    for notebook_path in notebook_paths:
+        inputs = detect_inputs(notebook_path)
+        last_run = state['notebooks'].get(notebook_path, {})
+        changed = [name for name in inputs if last_run.get(name) != hashes[name]]
+        if changed:
+            print(f'Re-running notebook: {notebook_path} (changed inputs: {", ".join(changed)})')
+            to_run[notebook_path] = inputs
+
+    with stage('notebooks'):
+        count('cache_hits', len(notebook_paths) - len(to_run))
+        count('cache_misses', len(to_run))
+        results = run_notebooks(list(to_run), args.jobs) if to_run else {}
+    for notebook_path, (status, _, _) in results.items():
+        if status == 'ok':
+            state['notebooks'][notebook_path] = {name: hashes[name] for name in to_run[notebook_path]}
+
+    save_state(state)
+
+    ##### Write update info to log file
+    with open('updated_data.log', 'w') as f:
+       f.write(', '.join(map((lambda d: d[0]), updated_data)))
+       f.write('\n')
+       f.write('\n'.join(map((lambda d: d[3]), updated_data)))
+       rendered = [path for path, result in figure_results.items() if result == 'rendered']
+       failed = {path: e for path, e in figure_results.items() if isinstance(e, Exception)}
+       f.write(f'\nfigures: {len(rendered)} rendered, {len(figure_results) - len(rendered) - len(failed)} unchanged')
+       for path, e in sorted(failed.items()):
+           f.write(f'\n{path}: failed ({e!r})')
+       for notebook_path, (status, duration, error) in sorted(results.items()):
+           f.write(f'\n{notebook_path}: {status} in {duration:.1f}s{f" ({error})" if error else ""}')
+       for fname, e in sorted(kba_errors.items()):
+           f.write(f'\n{fname}: failed ({e!r})')
+
+    instrumentation.finish_run()
+
+    # a file that cannot be parsed (eg. the KBA changed the layout) needs attention, a failed download is retried
+    parse_errors = [fname for fname, e in kba_errors.items() if isinstance(e, kba.fz28_file_errors())]
+    if parse_errors:
+        print(f'Failed to parse: {", ".join(sorted(parse_errors))}')
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,37 @@
+from __future__ import annotations
+
 import glob
+import hashlib
+import importlib.util
 import locale
 import os
+import sys
 from locale import getlocale, setlocale
 from contextlib import contextmanager
 from enum import StrEnum
-from typing import Tuple
+from typing import Optional, Tuple
+
 
-import numpy as np
-import pandas as pd
+def lazy_import(name: str):
+    """
+    Imports a module that is only loaded when one of its attributes is first used,
+    so modules can import heavy dependencies without slowing down the code paths that do not need them
+    (annotations using the module need "from __future__ import annotations")
+    :param name: Name of the module, eg. 'pandas' (submodules like 'pyarrow.parquet' load their parent package right away)
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
+
+
+np = lazy_import('numpy')
+pd = lazy_import('pandas')
 
 
 class PowerType(StrEnum):
@@ -58,6 +82,21 @@ def intor(val, default=0):
     except (ValueError, TypeError):
         return default
 
+def intor_array(values, default=0) -> np.ndarray:
+    """
+    Vectorized intor: converts an array of (spreadsheet) values to int64 like intor() does value by value,
+    numbers are truncated, strings only count if int() accepts them (so "12" is 12, but "12.7" becomes default)
+    """
+    values = np.asarray(values, dtype=object)
+    flat = values.ravel()
+    strings = np.fromiter((isinstance(v, str) for v in flat), dtype=bool, count=flat.size)
+    numbers = pd.to_numeric(pd.Series(np.where(strings, None, flat)), errors='coerce')
+    numbers = numbers.to_numpy(dtype='float64', na_value=np.nan)
+    result = np.where(np.isnan(numbers), default, np.trunc(numbers)).astype('int64')
+    # the few strings (eg. "-" for no registrations) are converted one by one, so they follow the rules of int()
+    result[strings] = [intor(v, default) for v in flat[strings]]
+    return result.reshape(values.shape)
+
 def floator(val, default=0.0):
     try:
         return float(val)
@@ -70,6 +109,13 @@ def newest_file_in_dir(dir_name, file_glob='*') -> Tuple[str, float]:
         return '', 0
     return os.path.basename(fmax), os.path.getmtime(fmax)
 
+def file_hash(path, chunk_size=1 << 20) -> str:
+    """ SHA-256 hex digest of the contents of a file """
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while chunk := f.read(chunk_size):
+            h.update(chunk)
+    return h.hexdigest()
 
 
 def correlate_slice_normalized(a: np.ndarray, v: np.ndarray, epsilon=0.001) -> Tuple[np.ndarray, np.ndarray]:
@@ -87,6 +133,50 @@ def correlate_slice_normalized(a: np.ndarray, v: np.ndarray, epsilon=0.001) -> T
     corrs = 2 * np.correlate(a, v, mode='full') / (norm_by_slice_a + norm_by_slice_v + epsilon)
     return offsets, corrs
 
+def correlate_full_batch(x: np.ndarray, y: np.ndarray, method='auto') -> np.ndarray:
+    """
+    Row-wise np.correlate(x[i], y[i], mode='full') of two 2-D arrays
+    (a single row is broadcast to all rows of the other array)
+    :param method: 'direct', 'fft' or 'auto' (FFT once the series get long)
+    """
+    x, y = np.atleast_2d(x), np.atleast_2d(y)
+    n, lx, ly = max(len(x), len(y)), x.shape[1], y.shape[1]
+    x, y = np.broadcast_to(x, (n, lx)), np.broadcast_to(y, (n, ly))
+    if method == 'auto':
+        method = 'fft' if min(lx, ly) > 64 else 'direct'
+    if method == 'fft':
+        nfft = 1 << (lx + ly - 2).bit_length()
+        return np.fft.irfft(np.fft.rfft(x, nfft) * np.fft.rfft(y[:, ::-1], nfft), nfft)[:, :lx + ly - 1]
+    # full correlation = sliding windows of the zero padded x times y
+    windows = np.lib.stride_tricks.sliding_window_view(np.pad(x, ((0, 0), (ly - 1, ly - 1))), ly, axis=1)
+    return np.einsum('ikj,ij->ik', windows, y)
+
+def correlate_slice_normalized_batch(a: np.ndarray, vs: np.ndarray, masks: Optional[np.ndarray] = None, epsilon=0.001,
+                                     method='auto') -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Batched correlate_slice_normalized: correlates a with all rows of vs in one vectorized call
+    :param a: The reference series
+    :param vs: 2-D array with one series per row, all on a common (padded) time grid, NaN for missing values
+    :param masks: Boolean array like vs, marking the extent of every series (default: the whole row like the scalar function).
+        A series placed on a row padded by p before its start gets the offsets of the scalar function - p
+    :param method: 'direct', 'fft' or 'auto' (FFT once the series get long)
+    :return: The offsets, the normalized correlations of every row for these offsets and the best offset of every row
+    """
+    a = np.asarray(a, dtype='float64')
+    vs = np.atleast_2d(np.asarray(vs, dtype='float64'))
+    masks = np.ones(vs.shape) if masks is None else np.asarray(masks, dtype='float64')
+    # fix nans, padding outside the masks does not contribute
+    a, vs = np.nan_to_num(a)[np.newaxis, :], np.nan_to_num(vs) * masks
+    mask_a = np.ones(a.shape)
+    if vs.shape[1] > a.shape[1]:
+        a, vs, mask_a, masks = vs, a, masks, mask_a
+    L, l = a.shape[1], vs.shape[1]
+    offsets = np.arange(-l+2, L+1)
+    norm_by_slice_a = correlate_full_batch(a*a, masks, method)
+    norm_by_slice_v = correlate_full_batch(mask_a, vs*vs, method)
+    corrs = 2 * correlate_full_batch(a, vs, method) / (norm_by_slice_a + norm_by_slice_v + epsilon)
+    return offsets, corrs, offsets[np.argmax(corrs, axis=1)]
+
 def df_shift_index(df: pd.DataFrame, n) -> pd.DataFrame:
     """ Shifts the index of a dataframe by n """
     df = df.copy()
@@ -98,15 +188,17 @@ def frequency_in_year(freq):
 
 def delta_frequency_to_string(dt, freq):
     fy = frequency_in_year(freq)
-    sign = '' if dt >= 0 else '-'
-    dt = abs(dt)
-    y = int(dt / fy)
-    r = dt % fy
+    sign = '' if round(dt, 1) >= 0 else '-'
+    # fractional offsets are shown to a tenth of a period, rounded before splitting off the years so they carry over
+    dt = round(abs(dt), 1)
+    # yearly offsets have no smaller unit, their fraction stays with the years
+    y = dt if fy == 1 else int(dt // fy)
+    r = round(dt - y * fy, 1)
     
     result = []
     
     if y != 0:
-        result.append(f"{y} year{'' if abs(y) == 1 else 's'}")
+        result.append(f"{y:g} year{'' if y == 1 else 's'}")
     
     
     if r != 0:
@@ -120,6 +212,6 @@ def delta_frequency_to_string(dt, freq):
             funit = 'day'
         else:
             funit = ''
-        result.append(f"{r} {funit}{'' if abs(r)==1 else 's'}")
+        result.append(f"{r:g} {funit}{'' if r == 1 else 's'}")
     
     return sign + ' '.join(result)
\ No newline at end of file
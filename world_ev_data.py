@@ -6,12 +6,19 @@ not all columns are always available, but the naming and the format is consisten
 """
 
 
+import glob
+import json
+import os
+import shutil
+import zipfile
 from enum import StrEnum
+from typing import Dict, List, Optional
 
 import pandas as pd
 import numpy as np
 
-from owid_datagrabber import owid_electric_car_sales
+from owid_datagrabber import electric_car_sales_file, owid_electric_car_sales
+from utils import file_hash
 
 
 class EntityType(StrEnum):
@@ -20,8 +27,10 @@ class EntityType(StrEnum):
     Group = "Group"
     World = "World"
 
+SOURCE = "source"
 ENTITY = "entity"
 ENTITY_TYPE = "entity_type"
+DATE = "date"
 STOCK_SHARE_EVS = "stock_share_evs"
 STOCK_SHARE_BEVS = "stock_share_bevs"
 STOCK_SHARE_PHEVS = "stock_share_phevs"
@@ -45,51 +54,134 @@ SALES_FCEVS = "sales_fcevs"
 SALES_ICE = "sales_ice"
 SALES_TOTAL = "sales_total"
 
+VALUE_COLUMNS = [
+    STOCK_SHARE_EVS, STOCK_SHARE_BEVS, STOCK_SHARE_PHEVS, STOCK_SHARE_FCEVS, STOCK_SHARE_ICE,
+    STOCK_EVS, STOCK_BEVS, STOCK_PHEVS, STOCK_FCEVS, STOCK_ICE, STOCK_TOTAL,
+    SALES_SHARE_EVS, SALES_SHARE_BEVS, SALES_SHARE_PHEVS, SALES_SHARE_FCEVS, SALES_SHARE_ICE,
+    SALES_EVS, SALES_BEVS, SALES_PHEVS, SALES_FCEVS, SALES_ICE, SALES_TOTAL,
+]
+""" All value columns, in the order of the merged data """
 
-def robbie_andrew_data(subsume_zev_into_bev=True, drop_before_year='2005') -> pd.DataFrame:
-    data = pd.read_csv('data/robbieandrew/all_carsales_monthly.csv', index_col=['Country', 'YYYYMM', 'Fuel'], parse_dates=['YYYYMM'], date_format={'YYYYMM': '%Y%m'})
-    data = data['Value'].unstack(level='Fuel').rename_axis(None, axis=1)
+merged_data_folder = "data/merged/ev_data"
+""" The merged data of all sources, a parquet dataset partitioned by source """
+
+merged_sources_file = f"{merged_data_folder}/_sources.json"
+""" Content hashes of the raw files the merged data was built from (not part of the dataset, as it starts with _) """
+
+
+robbie_andrew_file = 'data/robbieandrew/all_carsales_monthly.csv'
+
+
+def robbie_andrew_data(subsume_zev_into_bev=True, drop_before_year='2005', countries: Optional[List[str]] = None,
+                       chunksize: Optional[int] = None) -> pd.DataFrame:
+    """
+    Robbie Andrew's monthly car sales data by country and fuel type
+    :param subsume_zev_into_bev: Count ZEV sales as BEV sales (some countries only give ZEV data)
+    :param drop_before_year: Drop all months before this year
+    :param countries: Only read these countries (default: all)
+    :param chunksize: Read the file in chunks of this many rows, so only the filtered data is kept in memory at once
+    """
+    # Filter by date and country while reading, so the irrelevant rows are never pivoted
+    start = pd.Timestamp(drop_before_year)
+    start_yyyymm = start.year * 100 + start.month
+
+    def relevant(chunk: pd.DataFrame) -> pd.DataFrame:
+        mask = chunk['YYYYMM'] >= start_yyyymm
+        if countries is not None:
+            mask &= chunk['Country'].isin(countries)
+        return chunk.loc[mask]
+
+    reader = pd.read_csv(robbie_andrew_file, usecols=['Country', 'YYYYMM', 'Fuel', 'Value'],
+                         dtype={'Country': 'category', 'YYYYMM': 'int32', 'Fuel': 'category', 'Value': 'float64'},
+                         chunksize=chunksize)
+    if chunksize is None:
+        data = relevant(reader)
+    else:
+        # categories differ between the chunks, union them when concatenating
+        data = pd.concat([relevant(chunk) for chunk in reader], ignore_index=True)
+        for c in ['Country', 'Fuel']:
+            data[c] = data[c].astype(str).astype('category')
+
+    data = data.assign(
+        Country=data['Country'].cat.remove_unused_categories(),
+        Fuel=data['Fuel'].cat.remove_unused_categories(),
+        YYYYMM=pd.to_datetime(data['YYYYMM'].astype(str), format='%Y%m'),
+    )
+    data = data.set_index(['Country', 'YYYYMM', 'Fuel'])['Value'].unstack(level='Fuel')
+    data.columns = data.columns.astype(str).rename(None)
     data.rename(columns={
         'BatteryElectric': SALES_BEVS,
         'PluginHybrid': SALES_PHEVS,
     }, inplace=True)
-    data[SALES_TOTAL] = data[list(data.columns)].sum(axis=1)
+    data[SALES_TOTAL] = data.sum(axis=1)
     # Some rows do not contain data
-    data.drop(data[data[SALES_TOTAL] == 0].index, inplace=True)
-    # Crop to only relevant years
-    data.drop(data[data.index.get_level_values(1) < drop_before_year].index, inplace=True)
-    
+    data = data.loc[data[SALES_TOTAL] != 0].copy()
+
     # Merge columns
-    data[SALES_PHEVS] += data['Plug_inHybrid'].fillna(0)
-    data.drop(columns=['Plug_inHybrid'], inplace=True)
-    
+    data[SALES_PHEVS] += data.pop('Plug_inHybrid').fillna(0) if 'Plug_inHybrid' in data else 0
+
     # some countries only give ZEV data
     if subsume_zev_into_bev:
-        data[SALES_BEVS] += data['ZEV'].fillna(0)
-        data.drop(columns=['ZEV'], inplace=True)
-    
+        data[SALES_BEVS] += data.pop('ZEV').fillna(0) if 'ZEV' in data else 0
+
     # Calculate shares from absolute numbers
     # BEV and EV share are guaranteed to always be available
-    data[SALES_SHARE_BEVS] = data[SALES_BEVS].fillna(0) / data[SALES_TOTAL]
-    data[SALES_SHARE_PHEVS] = data[SALES_PHEVS] / data[SALES_TOTAL]
-    data[SALES_SHARE_EVS] = (data[SALES_BEVS].fillna(0) + data[SALES_PHEVS].fillna(0)) / data[SALES_TOTAL]
-    
-    data[ENTITY_TYPE] = EntityType.Country
-    data.loc[data.index.get_level_values(0).isin(['EFTA', 'EU + EFTA + UK', 'EUROPEAN UNION']), ENTITY_TYPE] = EntityType.Group
-    data.loc[data.index.get_level_values(0).isin(['California CNCDA', 'United Kingdom SMMT']), ENTITY_TYPE] = EntityType.CountryAlt
-    
-    return data
+    bevs, phevs = data[SALES_BEVS].fillna(0), data[SALES_PHEVS]
+    shares = pd.DataFrame({
+        SALES_SHARE_BEVS: bevs,
+        SALES_SHARE_PHEVS: phevs,
+        SALES_SHARE_EVS: bevs + phevs.fillna(0),
+    }).div(data[SALES_TOTAL], axis=0)
+
+    country = data.index.get_level_values(0)
+    entity_type = np.where(country.isin(['EFTA', 'EU + EFTA + UK', 'EUROPEAN UNION']), EntityType.Group,
+                           np.where(country.isin(['California CNCDA', 'United Kingdom SMMT']), EntityType.CountryAlt,
+                                    EntityType.Country))
+    return pd.concat([data, shares], axis=1).assign(**{ENTITY_TYPE: pd.Categorical(entity_type)})
+
+iea_file = "data/iea/EVDataExplorer2025.xlsx"
+
 
 def iea_data() -> pd.DataFrame:
-    data = pd.read_excel(f"data/iea/EVDataExplorer2025.xlsx", sheet_name="GEVO_EV_2025")
+    """
+    IEA Global EV Data Explorer data on cars.
+    The parsed result is cached in a parquet file next to the Excel file, keyed on the hash of the Excel file.
+    """
+    digest = file_hash(iea_file)
+    cache_file = f"{os.path.splitext(iea_file)[0]}.{digest[:16]}.parquet"
+    if os.path.exists(cache_file):
+        data = pd.read_parquet(cache_file)
+        # parquet only supports string column names
+        data.columns = [tuple(c.split('|')) if '|' in c else c for c in data.columns]
+        return data
+
+    data = iea_data_from_excel()
+
+    for stale_file in glob.glob(f"{os.path.splitext(iea_file)[0]}.*.parquet"):
+        os.remove(stale_file)
+    cached = data.copy()
+    cached.columns = ['|'.join(c) if isinstance(c, tuple) else c for c in cached.columns]
+    cached.to_parquet(cache_file)
+    return data
+
+
+def iea_data_from_excel() -> pd.DataFrame:
+    """ Parses the IEA Global EV Data Explorer Excel file (see iea_data() for the cached version) """
+    data = pd.read_excel(iea_file, sheet_name="GEVO_EV_2025",
+                         dtype={c: 'category' for c in ['region_country', 'category', 'parameter', 'mode', 'powertrain', 'unit']})
     data = data.loc[
         (data['category'] == 'Historical') &
         (data['mode'] == 'Cars') &
         (data['parameter'].isin(['EV sales', 'EV sales share', 'EV stock', 'EV stock share']))
     ]
-    data.drop(columns=['category', 'mode', 'unit'], inplace=True)
+    data = data.drop(columns=['category', 'mode', 'unit'])
+    data['year'] = data['year'].astype('int16')
+    data['value'] = data['value'].astype('float32')
+    # drop the categories that were filtered out, so they do not become empty rows / columns
+    for c in ['region_country', 'parameter', 'powertrain']:
+        data[c] = data[c].cat.remove_unused_categories()
     data.set_index(['region_country', 'year', 'parameter', 'powertrain'], inplace=True)
-    entity_to_agg = data['Aggregate group'].groupby('region_country').max()
+    entity_to_agg = data['Aggregate group'].groupby('region_country', observed=True).max()
     data.drop(columns=['Aggregate group'], inplace=True)
     data = data.unstack(level=['powertrain', 'parameter'])
     data.columns = data.columns.to_flat_index()
@@ -117,6 +209,7 @@ def iea_data() -> pd.DataFrame:
     data[ENTITY_TYPE] = EntityType.Group
     data.loc[data.index.get_level_values(0).isin(entity_to_agg.loc[entity_to_agg == 'Other'].index), ENTITY_TYPE] = EntityType.Country
     data.loc[data.index.get_level_values(0).isin(['World']), ENTITY_TYPE] = EntityType.World
+    data[ENTITY_TYPE] = data[ENTITY_TYPE].astype('category')
     
     return data
 
@@ -151,10 +244,13 @@ def owid_data() -> pd.DataFrame:
     
     return data
 
+vietnam_file = 'data/vietnam/vietnam_ev_sales_share.csv'
+
+
 def extra_data() -> pd.DataFrame:
     
     # Manually collected data on Vietnam
-    data_vietnam = pd.read_csv('data/vietnam/vietnam_ev_sales_share.csv')
+    data_vietnam = pd.read_csv(vietnam_file)
     data_vietnam.rename(columns={
         'bev_sales_share': SALES_SHARE_BEVS
     }, inplace=True)
@@ -169,23 +265,182 @@ def extra_data() -> pd.DataFrame:
     
     return data_vietnam
 
-def merge_all_ev_data(interpolate=True):
-    """Merges all data sources into one dataframe"""
-    
-    owid_car_sales = owid_data()
-    robbie_andrew_car_sales = robbie_andrew_data()
-    iea_car_sales = iea_data()
-    extra_car_sales = extra_data()
-    
-    # Take Robbie Andrew's data as base,
-    # then fill it with IEA and OWID data
-    # and use the extra data to add / update more current data
-    
-    # TODO: make sure all dates have the same format and are parsed correctly
-    # TODO: implement merging of data
-    
-    print('Hello')
+def period_start(periods: pd.Index) -> pd.DatetimeIndex:
+    """
+    Converts the periods used by the sources to the dates at which the periods start:
+    Years (eg. 2024) become 2024-01-01, YYYYMM values (eg. 202403) become 2024-03-01, dates are kept
+    """
+    if pd.api.types.is_datetime64_any_dtype(periods):
+        return pd.DatetimeIndex(periods)
+    periods = periods.astype(str)
+    if periods.str.len().max() <= 4:
+        return pd.to_datetime(periods, format='%Y')
+    return pd.to_datetime(periods.str.replace('-', ''), format='%Y%m')
+
+
+def normalize(data: pd.DataFrame, source: str) -> pd.DataFrame:
+    """ Converts the data of a single source to the long format of the merged data """
+    data = data.reindex(columns=[ENTITY_TYPE] + VALUE_COLUMNS)
+    data[VALUE_COLUMNS] = data[VALUE_COLUMNS].astype('float64')
+    data.index = pd.MultiIndex.from_arrays(
+        [data.index.get_level_values(0).astype(str), period_start(data.index.get_level_values(1))], names=[ENTITY, DATE])
+    data = data.reset_index()
+    data.insert(0, SOURCE, source)
+    data[ENTITY_TYPE] = data[ENTITY_TYPE].astype(str)
+    return data
+
+
+source_loaders = {
+    'extra': extra_data,
+    'robbieandrew': robbie_andrew_data,
+    'iea': iea_data,
+    'owid': owid_data,
+}
+""" The loaders of all sources, in order of precedence in the consolidated data """
+
+source_files = {
+    'extra': vietnam_file,
+    'robbieandrew': robbie_andrew_file,
+    'iea': iea_file,
+    'owid': electric_car_sales_file,
+}
+""" The raw file of every source, the merged data is rebuilt when one of them changes """
+
+source_periods = {
+    'extra': 'monthly',
+    'robbieandrew': 'monthly',
+    'iea': 'yearly',
+    'owid': 'yearly',
+}
+""" The length of the periods of every source """
+
+CONSOLIDATED = "consolidated"
+""" Prefix of the sources of the consolidated data, eg. "consolidated_yearly" """
+
+
+def consolidate(data: pd.DataFrame) -> pd.DataFrame:
+    """
+    Consolidates the normalized data of all sources into one series per entity, date and period length:
+    every value is taken from the first source in source_loaders that has it.
+    Monthly and yearly data are consolidated separately (a year and its first month start on the same date),
+    so the monthly series are Robbie Andrew's data, added to and updated by the manually collected extra data,
+    and the yearly series are the IEA data, filled with OWID data.
+    :param data: Data like normalize(), of several sources
+    :return: Data like normalize(), with the sources CONSOLIDATED + "_monthly" and CONSOLIDATED + "_yearly"
+    """
+    rank = data[SOURCE].map({source: i for i, source in enumerate(source_loaders)})
+    ordered = data.iloc[np.argsort(rank.to_numpy(), kind='stable')]
+    periods = ordered[SOURCE].map(source_periods).rename(SOURCE)
+    # first() takes the first non-missing value of every column
+    merged = ordered.groupby([CONSOLIDATED + '_' + periods, ENTITY, DATE])[[ENTITY_TYPE] + VALUE_COLUMNS].first()
+    return merged.reset_index()
+
+
+source_errors = (OSError, KeyError, ValueError, zipfile.BadZipFile)
+""" Errors of a source loader that mean its raw file is missing or malformed """
+
+
+def source_hashes() -> Dict[str, Optional[str]]:
+    """ :return: The content hash of the raw file of every source (None if it is not available) """
+    return {source: file_hash(file) if os.path.exists(file) else None for source, file in source_files.items()}
+
+
+def merged_source_hashes() -> Dict[str, Optional[str]]:
+    """ :return: The source hashes the merged data was built from (empty if there is no merged data) """
+    if not os.path.exists(merged_sources_file):
+        return {}
+    with open(merged_sources_file, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def read_merged_sources(sources: List[str]) -> pd.DataFrame:
+    """ Reads the partitions of the given sources of the merged data, in the format of normalize() """
+    data = pd.read_parquet(merged_data_folder, filters=[(SOURCE, 'in', sources)])
+    data[SOURCE] = data[SOURCE].astype(str)
+    data[ENTITY_TYPE] = data[ENTITY_TYPE].astype(str)
+    return data[[SOURCE, ENTITY, DATE, ENTITY_TYPE] + VALUE_COLUMNS]
+
+
+def merge_all_ev_data() -> pd.DataFrame:
+    """
+    Merges all data sources into one long format table (source, entity, date, entity type and the value columns),
+    adds their consolidation (see consolidate())
+    and writes it to merged_data_folder, from where load_ev_data() can read only the parts that are needed.
+    Only the sources whose raw files changed since the last merge are loaded again, the others are read from the
+    merged data. Sources whose raw files are not available are skipped, the previous data of a source that fails to
+    load is kept (and loading it is retried by the next merge).
+    """
+    hashes = source_hashes()
+    merged_hashes = merged_source_hashes()
+    parts = []
+    kept = []
+    for source, loader in source_loaders.items():
+        merged = merged_hashes.get(source) is not None and os.path.isdir(f"{merged_data_folder}/{SOURCE}={source}")
+        if merged and merged_hashes[source] == hashes[source]:
+            kept.append(source)
+            continue
+        try:
+            parts.append(normalize(loader(), source))
+        except FileNotFoundError as e:
+            print(f"Skipping source {source}: {e}")
+        except source_errors as e:
+            print(f"Failed to load source {source}: {e!r}")
+            # recording the hash of the previous data makes the next merge retry the source
+            hashes[source] = merged_hashes[source] if merged else None
+            if merged:
+                kept.append(source)
+    if kept:
+        parts.append(read_merged_sources(kept))
+
+    data = pd.concat(parts, ignore_index=True)
+    data = pd.concat([data, consolidate(data)], ignore_index=True)
+    data[ENTITY_TYPE] = data[ENTITY_TYPE].astype('category')
+
+    # the whole dataset is written to a temporary folder and swapped in, so readers never see a partial dataset,
+    # sources that are gone do not linger, and a failed merge leaves the previous data in place
+    tmp_folder = f"{merged_data_folder}.tmp"
+    old_folder = f"{merged_data_folder}.old"
+    for folder in [tmp_folder, old_folder]:
+        if os.path.exists(folder):
+            shutil.rmtree(folder)
+    data.to_parquet(tmp_folder, partition_cols=[SOURCE], index=False)
+    with open(f"{tmp_folder}/{os.path.basename(merged_sources_file)}", 'w', encoding='utf-8') as f:
+        json.dump(hashes, f, indent=2, sort_keys=True)
+    if os.path.exists(merged_data_folder):
+        os.replace(merged_data_folder, old_folder)
+    os.replace(tmp_folder, merged_data_folder)
+    shutil.rmtree(old_folder, ignore_errors=True)
+    return data
+
+
+def merged_data_stale() -> bool:
+    """ :return: Whether the merged data is missing or was built from other raw files than the current ones """
+    return merged_source_hashes() != source_hashes()
+
+
+def load_ev_data(columns: Optional[List[str]] = None, entities: Optional[List[str]] = None,
+                 sources: Optional[List[str]] = None) -> pd.DataFrame:
+    """
+    Reads the merged data written by merge_all_ev_data() (which is run first if it is missing or out of date)
+    :param columns: Only read these value columns (default: all)
+    :param entities: Only read these entities (default: all)
+    :param sources: Only read these sources, eg. ['owid'] or ['consolidated_yearly'] (default: all)
+    :return: The data indexed by (source, entity, date)
+    """
+    if merged_data_stale():
+        merge_all_ev_data()
+
+    filters = []
+    if entities is not None:
+        filters.append((ENTITY, 'in', list(entities)))
+    if sources is not None:
+        filters.append((SOURCE, 'in', list(sources)))
+    index = [SOURCE, ENTITY, DATE]
+    data = pd.read_parquet(merged_data_folder, columns=None if columns is None else index + [ENTITY_TYPE] + list(columns),
+                           filters=filters or None)
+    data[SOURCE] = data[SOURCE].astype(str)
+    return data.set_index(index).sort_index()
 
 
 if __name__ == "__main__":
-    merge_all_ev_data()
\ No newline at end of file
+    merge_all_ev_data()
@@ -0,0 +1,113 @@
+"""
+Figures of the time-aligned EV sales share trajectories of all countries, see world_ev_trajectories.ipynb
+"""
+
+from typing import Dict, List, Optional, Tuple, Union
+
+import numpy as np
+import pandas as pd
+import matplotlib.pyplot as plt
+
+from alignment import AlignmentResult, align_trajectories
+import figure_pipeline
+import owid_datagrabber
+from figure_pipeline import Figure
+from utils import df_shift_index
+
+figures_folder = 'figures/world/ev_trajectories'
+
+aggregate_entities = ['World', 'European Union (27)', 'Europe']
+""" Entities of the OWID data that are not countries """
+
+mean_labels = {'EV': 'EVs (including PHEV)', 'BEV': 'BEVs'}
+
+
+def country_sales(e_car_sales: pd.DataFrame) -> pd.DataFrame:
+    """ The car sales of countries only (without aggregates like World) """
+    only_countries = np.invert(e_car_sales.index.get_level_values(0).isin(aggregate_entities))
+    return e_car_sales[only_countries]
+
+
+def align_countries(relevant_sales: pd.DataFrame) -> AlignmentResult:
+    """ Aligns the EV and BEV sales share trajectories of all countries """
+    return align_trajectories(relevant_sales, {'EV': 'ev_sales_share', 'BEV': 'bev_share_car_sales'}, 'total_cars_sold')
+
+
+def _style_share_axes(ax):
+    ax.set_ylim(-5, 105)
+    ax.yaxis.set_label_position("right")
+    ax.yaxis.tick_right()
+    ax.spines['top'].set_visible(False)
+    ax.spines['left'].set_visible(False)
+    ax.spines['right'].set_visible(False)
+    ax.tick_params(axis='y', which='major', length=0)
+    ax.grid(linestyle='--', alpha=0.5, axis='y')
+
+
+def plot_all_trajectories(data: Tuple[pd.DataFrame, pd.DataFrame]) -> plt.Figure:
+    """
+    :param data: The time-shifted EV sales shares of all countries and the average trajectories (AlignmentResult.mean)
+    """
+    shifted_ev, mean = data
+    ax = shifted_ev.plot(figsize=(10, 5), legend=False, alpha=0.3, color='grey', lw=1)
+    ax = mean[['EV', 'BEV']].rename(columns=mean_labels).plot(ax=ax, figsize=(10, 5), legend=True)
+    ax.set_title('All countries time-shifted EV sales share vs average trajectory')
+    ax.set_xlabel('Year (only for average, others are time-shifted)')
+    ax.set_ylabel('Sales Share (%)')
+    _style_share_axes(ax)
+    ax.figure.tight_layout()
+    return ax.figure
+
+
+def plot_country_trajectory(data: Tuple[pd.DataFrame, pd.DataFrame], country: str, offset: int) -> plt.Figure:
+    """
+    :param data: The sales of the country and the average trajectories shifted to it
+    :param country: Name of the country
+    :param offset: Time shift of the country to the average trajectories
+    """
+    sales, shifted_mean = data
+    ax = sales['ev_sales_share'].plot(figsize=(10, 5), legend=True, label='EVs (including PHEV)')
+    ax = sales['bev_share_car_sales'].plot(ax=ax, figsize=(10, 5), legend=True, label='BEVs')
+    ax = shifted_mean[['EV', 'BEV']].plot(ax=ax, figsize=(10, 5), alpha=0.3, legend=False)
+    ax.set_title(f'{country} EV sales, shift = {offset} years')
+    ax.set_xlabel('Year')
+    ax.set_ylabel('Sales Share (%)')
+    _style_share_axes(ax)
+    ax.figure.tight_layout()
+    return ax.figure
+
+
+def figures(e_car_sales: pd.DataFrame) -> List[Figure]:
+    """
+    :param e_car_sales: The OWID electric car sales (owid_electric_car_sales())
+    :return: The aligned trajectories figure and the trajectory figure of every country, each with the data slice it is drawn from
+    """
+    relevant_sales = country_sales(e_car_sales)
+    alignment = align_countries(relevant_sales)
+    countries_offsets = alignment.offsets.to_dict()
+
+    result = [Figure(f'{figures_folder}/all_ev_trajectories', plot_all_trajectories,
+                     (alignment.shifted['EV'], alignment.mean))]
+    for c in sorted(countries_offsets.keys(), key=lambda x: countries_offsets[x], reverse=True):
+        offset = int(countries_offsets[c])
+        sales = relevant_sales.loc[c][['ev_sales_share', 'bev_share_car_sales']]
+        result.append(Figure(f'{figures_folder}/ev_trajectory_{c}', plot_country_trajectory,
+                             (sales, df_shift_index(alignment.mean, -offset)), dict(country=c, offset=offset)))
+    return result
+
+
+def render_all(jobs: Optional[int] = None, force: bool = False, update: bool = False) -> Dict[str, Union[str, Exception]]:
+    """
+    Renders all trajectory figures whose data or code changed
+    :param jobs: Number of rendering processes (default: all cores)
+    :param force: Redraw all figures
+    :param update: Update the OWID data first
+    :return: The result of render_figures()
+    """
+    if update:
+        owid_datagrabber.ensure_up_to_date()
+    return figure_pipeline.render_figures(figures(owid_datagrabber.owid_electric_car_sales()), jobs, force)
+
+
+if __name__ == "__main__":
+    figure_pipeline.main('Renders the aligned EV sales share trajectories of all countries', render_all)